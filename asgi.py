@@ -0,0 +1,210 @@
+import asyncio
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import database_helper
+import metrics
+import server
+
+# Asyncio serving mode. The flask_sock handler keeps one OS thread blocked in ws.receive()
+# for every open websocket; here /ws is served natively by the event loop so an idle socket
+# only costs a coroutine. Every other route is the unchanged Flask app run on a bounded
+# thread pool, so the HTTP API and its signature checks are exactly the same. Database work
+# of the websockets goes through db_call, which runs the database_helper functions on a
+# small dedicated thread pool inside an app context.
+#
+#   uvicorn asgi:application --port 8000 --ws-ping-interval 25 --ws-ping-timeout 25
+#
+# Heartbeats are left to the server: uvicorn pings every socket and drops the ones that do
+# not answer, which ends their session here like any other disconnect. The capacity cap and
+# the sign in timeout are the same as in server.py.
+HTTP_THREADS = int(os.environ.get("TWIDDER_HTTP_THREADS", 32))
+DB_THREADS = int(os.environ.get("TWIDDER_DB_THREADS", 4))
+
+http_executor = ThreadPoolExecutor(HTTP_THREADS, thread_name_prefix="http")
+db_executor = ThreadPoolExecutor(DB_THREADS, thread_name_prefix="db")
+
+def call_in_app_context(fn, args):
+    with server.app.app_context():
+        return fn(*args)
+
+async def db_call(fn, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, call_in_app_context, fn, args)
+
+#----------------------------------------websocket----------------------------------------
+class AsyncSocket:
+    # stands in for a flask_sock socket in server.active_sessions. send and close may be
+    # called from any thread (post_message runs on the http pool), the frames are handed
+    # to the event loop and written by run()
+    def __init__(self, loop, send):
+        self.loop = loop
+        self.asgi_send = send
+        self.frames = asyncio.Queue()
+
+    def send(self, frame):
+        self.loop.call_soon_threadsafe(self.frames.put_nowait, frame)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.frames.put_nowait, None)
+
+    async def run(self):
+        while True:
+            frame = await self.frames.get()
+            if frame is None:
+                await self.asgi_send({"type": "websocket.close", "code": 1000})
+                return
+            await self.asgi_send({"type": "websocket.send", "text": frame})
+
+async def receive_text(receive):
+    #returns the next text frame, None once the client disconnected
+    while True:
+        message = await receive()
+        if message["type"] == "websocket.disconnect":
+            return None
+        if message["type"] == "websocket.receive":
+            if message.get("text") is not None:
+                return message["text"]
+            return message.get("bytes", b"").decode('utf-8', 'replace')
+
+async def websocket_session(scope, receive, send):
+    message = await receive()
+    if message["type"] != "websocket.connect":
+        return
+    await send({"type": "websocket.accept"})
+    if not server.acquire_websocket_slot():
+        await send({"type": "websocket.close", "code": server.WS_TRY_AGAIN_LATER, "reason": "Server busy, try again later"})
+        return
+    try:
+        await authenticated_session(receive, send)
+    finally:
+        server.release_websocket_slot()
+
+async def authenticated_session(receive, send):
+    try:
+        token = await asyncio.wait_for(receive_text(receive), server.WS_AUTH_TIMEOUT)
+    except asyncio.TimeoutError:
+        metrics.websockets_evicted.inc(1, "auth_timeout")
+        await send({"type": "websocket.close", "code": 1000})
+        return
+    email = await db_call(database_helper.getEmailByToken, token) if token else None
+    if not email:
+        #tell the client to drop its token, or it would reconnect with it forever
+        await send({"type": "websocket.send", "text": "logout"})
+        await send({"type": "websocket.close", "code": server.WS_AUTH_FAILED, "reason": "Session expired"})
+        return
+
+    loop = asyncio.get_running_loop()
+    ws = AsyncSocket(loop, send)
+    writer = asyncio.create_task(ws.run())
+    # the registry may publish on the session bus, keep that off the event loop
+    await loop.run_in_executor(db_executor, server.active_sessions.register, email, ws)
+    try:
+        while not writer.done():
+            message = await receive_text(receive)
+            if message is None:
+                break
+            reply = await db_call(server.handle_ws_message, email, message)
+            if reply is not None:
+                ws.send(reply)
+    finally:
+        await loop.run_in_executor(db_executor, server.active_sessions.unregister, email, ws)
+        if not writer.done():
+            ws.close()
+        try:
+            await writer
+        except Exception:
+            pass
+
+#----------------------------------------http----------------------------------------
+def wsgi_environ(scope, body):
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode('utf-8').decode('latin-1'),
+        "PATH_INFO": scope["path"].encode('utf-8').decode('latin-1'),
+        "QUERY_STRING": scope.get("query_string", b"").decode('latin-1'),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": scope["client"][0] if scope.get("client") else "",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode('latin-1').upper().replace("-", "_")
+        value = value.decode('latin-1')
+        if name == "CONTENT_TYPE" or name == "CONTENT_LENGTH":
+            key = name
+        else:
+            key = "HTTP_" + name
+        environ[key] = environ[key] + "," + value if key in environ else value
+    return environ
+
+def run_wsgi(loop, environ, send):
+    #runs on the http pool and forwards every chunk of the body as soon as flask yields it
+    def asgi_send(message):
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"] = int(status.split(" ", 1)[0])
+        started["headers"] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+    result = server.app.wsgi_app(environ, start_response)
+    try:
+        asgi_send({"type": "http.response.start", "status": started["status"], "headers": started["headers"]})
+        for chunk in result:
+            if chunk:
+                asgi_send({"type": "http.response.body", "body": chunk, "more_body": True})
+        asgi_send({"type": "http.response.body", "body": b""})
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+
+async def http_request(scope, receive, send):
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(http_executor, run_wsgi, loop, wsgi_environ(scope, body), send)
+
+#----------------------------------------application----------------------------------------
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            server.start_session_reaper()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def application(scope, receive, send):
+    if scope["type"] == "http":
+        await http_request(scope, receive, send)
+    elif scope["type"] == "websocket":
+        if scope["path"] == "/ws":
+            await websocket_session(scope, receive, send)
+        else:
+            await send({"type": "websocket.close", "code": 1000})
+    elif scope["type"] == "lifespan":
+        await lifespan(scope, receive, send)
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(application, host="127.0.0.1", port=8000)
@@ -0,0 +1,68 @@
+import hashlib
+import json
+import os
+
+import compression
+
+# Build step for the static files. `flask --app server build-assets` copies every asset to
+# static/dist under a name containing its content hash (client.<hash>.js), writes gzip and
+# brotli versions next to the compressible ones and rewrites client.html to point at the
+# fingerprinted names. Fingerprinted files never change, so they are served with an
+# immutable Cache-Control and browsers stop asking for them; only client.html is revalidated.
+STATIC_DIR = "static"
+DIST_DIR = os.path.join(STATIC_DIR, "dist")
+MANIFEST = os.path.join(DIST_DIR, "manifest.json")
+ASSETS = ("client.js", "client.css", "wimage.png")
+PAGE = "client.html"
+COMPRESSIBLE = (".html", ".js", ".css", ".json", ".svg")
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()[:12]
+
+def write_asset(name, data):
+    #writes the file and its precompressed versions, returns the encodings that were written
+    with open(os.path.join(DIST_DIR, name), "wb") as f:
+        f.write(data)
+    encodings = []
+    if name.endswith(COMPRESSIBLE):
+        for encoding in compression.ENCODINGS:
+            compressed = compression.compress(data, encoding, best=True)
+            if len(compressed) < len(data):
+                with open(os.path.join(DIST_DIR, name + "." + ("gz" if encoding == "gzip" else encoding)), "wb") as f:
+                    f.write(compressed)
+                encodings.append(encoding)
+    return encodings
+
+def build():
+    os.makedirs(DIST_DIR, exist_ok=True)
+    for name in os.listdir(DIST_DIR):
+        os.remove(os.path.join(DIST_DIR, name))
+    manifest = {"assets": {}, "files": {}}
+    for asset in ASSETS:
+        with open(os.path.join(STATIC_DIR, asset), "rb") as f:
+            data = f.read()
+        digest = content_hash(data)
+        stem, ext = os.path.splitext(asset)
+        name = f"{stem}.{digest}{ext}"
+        manifest["assets"][asset] = name
+        manifest["files"][name] = {"etag": digest, "encodings": write_asset(name, data)}
+
+    with open(os.path.join(STATIC_DIR, PAGE), encoding="utf-8") as f:
+        page = f.read()
+    for asset, name in manifest["assets"].items():
+        page = page.replace(f"/static/{asset}", f"/assets/{name}")
+    data = page.encode("utf-8")
+    manifest["files"][PAGE] = {"etag": content_hash(data), "encodings": write_asset(PAGE, data)}
+
+    with open(MANIFEST, "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+def load_manifest():
+    #None when the assets were never built, the server then serves static/ as before
+    try:
+        with open(MANIFEST) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
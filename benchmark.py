@@ -0,0 +1,228 @@
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import simple_websocket
+
+# Load test for a running server. Seeds users, signs them in and then drives every route
+# at the given concurrency, signing requests the same way static/client.js does
+# (HMAC-SHA256 of "<timestamp>.<body>" keyed with the session token).
+#
+#   TWIDDER_RATE_LIMIT=0 python server.py &
+#   python benchmark.py --url http://127.0.0.1:5000 --users 50 --concurrency 16 --output bench.json
+#
+# Results are written as JSON so runs of two commits can be compared.
+
+PASSWORD = "benchmark-password"
+RATE_LIMITED = "The server is rate limiting the benchmark, restart it with TWIDDER_RATE_LIMIT=0"
+
+class Client:
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def request(self, method, path, data=None, email=None, token=None):
+        #returns (status, parsed json body or None)
+        body = json.dumps(data) if data is not None else ""
+        headers = {"Content-Type": "application/json"}
+        if token is not None:
+            timestamp = str(int(time.time()))
+            headers["email"] = email
+            headers["Timestamp"] = timestamp
+            headers["Signature"] = hmac.new(
+                token.encode('utf-8'), f"{timestamp}.{body}".encode('utf-8'), hashlib.sha256
+            ).hexdigest()
+        req = urllib.request.Request(self.url + path, data=body.encode('utf-8') if body else None, headers=headers, method=method)
+        try:
+            with urllib.request.urlopen(req, timeout=30) as response:
+                return response.status, json.loads(response.read() or b"null")
+        except urllib.error.HTTPError as e:
+            return e.code, None
+
+    def sign_up(self, email):
+        status, body = self.request("POST", "/sign_up", {
+            "email": email, "password": PASSWORD, "firstname": "Bench", "familyname": "User",
+            "gender": "other", "city": "Linkoping", "country": "Sweden",
+        })
+        if status == 429:
+            raise SystemExit(RATE_LIMITED)
+        return status, body
+
+    def sign_in(self, email):
+        status, body = self.request("POST", "/sign_in", {"username": email, "password": PASSWORD})
+        if status == 429:
+            raise SystemExit(RATE_LIMITED)
+        if status != 200:
+            raise RuntimeError(f"sign in of {email} failed with {status}")
+        return body["data"]
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+def summarize(route, latencies, errors, elapsed, rejected=0):
+    return {
+        "route": route,
+        "requests": len(latencies) + errors + rejected,
+        "errors": errors,
+        "rejected": rejected,
+        "throughput": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+    }
+
+def run_route(route, call, requests, concurrency):
+    #runs call(i) requests times on concurrency threads, call returns the http status.
+    #429 and 503 are the server shedding load and are counted as rejected, not as errors
+    latencies = []
+    errors = 0
+    rejected = 0
+    lock = threading.Lock()
+
+    def one(i):
+        nonlocal errors, rejected
+        start = time.perf_counter()
+        try:
+            status = call(i)
+        except Exception:
+            status = None
+        elapsed_ms = round((time.perf_counter() - start) * 1000, 3)
+        with lock:
+            if status in (200, 304):
+                latencies.append(elapsed_ms)
+            elif status in (429, 503):
+                rejected += 1
+            else:
+                errors += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(one, range(requests)))
+    return summarize(route, latencies, errors, time.perf_counter() - start, rejected)
+
+def run_ws_fanout(client, ws_url, users, tokens, requests, concurrency):
+    #every user keeps a socket open, posts go to a random wall and we time until the frame arrives
+    sockets = {}
+    for email in users:
+        ws = simple_websocket.Client.connect(ws_url)
+        ws.send(tokens[email])
+        sockets[email] = ws
+    time.sleep(0.5)
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    wall_locks = {email: threading.Lock() for email in users}
+
+    def one(i):
+        nonlocal errors
+        sender = users[i % len(users)]
+        recipient = users[(i * 7 + 1) % len(users)]
+        text = f"fanout {i} {time.time()}"
+        #one post per wall at a time so we know which frame belongs to which post
+        with wall_locks[recipient]:
+            start = time.perf_counter()
+            status, _ = client.request("POST", "/post_message", {"message": text, "email": recipient}, sender, tokens[sender])
+            received = False
+            while status == 200:
+                frame = sockets[recipient].receive(timeout=5)
+                if frame is None:
+                    break
+                if frame != "logout" and json.loads(frame).get("post") == text:
+                    received = True
+                    break
+            elapsed_ms = round((time.perf_counter() - start) * 1000, 3)
+        with lock:
+            if received:
+                latencies.append(elapsed_ms)
+            else:
+                errors += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(one, range(requests)))
+    elapsed = time.perf_counter() - start
+    for ws in sockets.values():
+        ws.close()
+    return summarize("ws_fanout", latencies, errors, elapsed)
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test a running Twidder server")
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--users", type=int, default=20, help="number of users to seed and sign in")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=500, help="requests per route")
+    parser.add_argument("--routes", default="sign_in,get_user_data_by_token,get_user_messages_by_token,get_user_messages_by_email,post_message,ws_fanout")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    client = Client(args.url)
+    ws_url = args.url.replace("http", "ws", 1).rstrip("/") + "/ws"
+    run_id = os.getpid()
+    users = [f"bench{run_id}-{i}@bench.se" for i in range(args.users)]
+    for email in users:
+        client.sign_up(email)
+    tokens = {email: client.sign_in(email) for email in users}
+
+    def user(i):
+        return users[i % len(users)]
+
+    def signed(method, path_for, data_for=None):
+        def call(i):
+            email = user(i)
+            return client.request(method, path_for(i), data_for(i) if data_for else None, email, tokens[email])[0]
+        return call
+
+    routes = {
+        "sign_in": lambda i: client.request("POST", "/sign_in", {"username": user(i), "password": PASSWORD})[0],
+        "get_user_data_by_token": signed("GET", lambda i: "/get_user_data_by_token"),
+        "get_user_messages_by_token": signed("GET", lambda i: "/get_user_messages_by_token"),
+        "get_user_messages_by_email": signed("GET", lambda i: "/get_user_messages_by_email/" + user(i + 1)),
+        "post_message": signed("POST", lambda i: "/post_message", lambda i: {"message": f"benchmark post {i}", "email": user(i + 1)}),
+    }
+
+    results = []
+    for route in args.routes.split(","):
+        if route == "ws_fanout":
+            result = run_ws_fanout(client, ws_url, users, tokens, args.requests, args.concurrency)
+        else:
+            result = run_route(route, routes[route], args.requests, args.concurrency)
+        if route == "sign_in":
+            #signing in replaced the tokens, get a fresh one for every user
+            tokens = {email: client.sign_in(email) for email in users}
+        results.append(result)
+        print(f"{route:28} {result['throughput']} req/s  p50 {result['p50_ms']} ms  "
+              f"p95 {result['p95_ms']} ms  p99 {result['p99_ms']} ms  errors {result['errors']}  rejected {result['rejected']}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "commit": git_commit(),
+                "timestamp": int(time.time()),
+                "url": args.url,
+                "users": args.users,
+                "concurrency": args.concurrency,
+                "requests": args.requests,
+                "results": results,
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import json
+import random
+
+import database_helper
+import password_hasher
+
+# Bulk loading for scaling tests, used by the generate-data, export-data and import-data
+# commands. Rows are written in batches of one transaction each through the same
+# database_helper functions the server uses, so wall versions and the search index stay
+# consistent. Every generated user shares one password hash, computed once up front.
+#
+# Dumps are NDJSON, one {"table": ..., "row": {...}} object per line, users first. Sessions
+# are not exported: they are credentials and expire anyway. The import bumps the wall versions
+# and the triggers index the posts for search, like any other insert.
+BATCH_SIZE = 5000 # rows per transaction
+GENERATED_DOMAIN = "twidder.test"
+USER_COLUMNS = ("email", "password", "firstname", "lastname", "gender", "city", "country")
+POST_COLUMNS = ("post_id", "sent_by", "sent_to", "post")
+
+FIRSTNAMES = ("Alice", "Bob", "Carol", "David", "Erik", "Fatima", "Goran", "Hanna", "Ivan", "Julia", "Karl", "Lina")
+LASTNAMES = ("Andersson", "Johansson", "Karlsson", "Nilsson", "Eriksson", "Larsson", "Olsson", "Persson")
+GENDERS = ("male", "female", "other")
+CITIES = (("Linkoping", "Sweden"), ("Stockholm", "Sweden"), ("Oslo", "Norway"), ("Helsinki", "Finland"), ("Copenhagen", "Denmark"))
+WORDS = (
+    "hello", "world", "coffee", "snow", "summer", "lecture", "exam", "party", "weekend", "friends",
+    "music", "train", "late", "again", "today", "tomorrow", "great", "thanks", "see", "you",
+)
+
+def batched(rows, size=BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def generated_email(prefix, i):
+    return f"{prefix}{i}@{GENERATED_DOMAIN}"
+
+def generate(db, users, posts, password, prefix="user", batch_size=BATCH_SIZE, seed=None):
+    # adds users users and posts posts between random pairs of them, returns both counts.
+    # Users are numbered, so a second run with another prefix adds to the same database
+    rng = random.Random(seed)
+    pw_hash = password_hasher.hash_password(password, password_hasher.BCRYPT_LOG_ROUNDS)
+
+    def user_rows():
+        for i in range(users):
+            city, country = rng.choice(CITIES)
+            yield (generated_email(prefix, i), pw_hash, rng.choice(FIRSTNAMES), rng.choice(LASTNAMES),
+                   rng.choice(GENDERS), city, country)
+
+    def post_rows():
+        for _ in range(posts):
+            text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))
+            yield (generated_email(prefix, rng.randrange(users)), generated_email(prefix, rng.randrange(users)), text)
+
+    added = 0
+    for batch in batched(user_rows(), batch_size):
+        added += database_helper.add_users(db, batch)
+    posted = 0
+    if users:
+        for batch in batched(post_rows(), batch_size):
+            posted += len(database_helper.add_posts(batch))
+    return added, posted
+
+def export(db, out):
+    # streams users and posts to the file object out, returns the number of rows per table
+    counts = {}
+    def all_posts():
+        for posts_db in database_helper.posts_dbs():
+            yield from database_helper.iterPosts(posts_db)
+
+    for table, columns, rows in (("users", USER_COLUMNS, database_helper.iterUsers(db)),
+                                 ("posts", POST_COLUMNS, all_posts())):
+        counts[table] = 0
+        for row in rows:
+            out.write(json.dumps({"table": table, "row": dict(zip(columns, row))}) + "\n")
+            counts[table] += 1
+    return counts
+
+def import_users(db, rows, renumber):
+    return database_helper.add_users(db, rows)
+
+def import_posts(db, rows, renumber):
+    if renumber:
+        return len(database_helper.add_posts([row[1:] for row in rows]))
+    return database_helper.restore_posts(rows)
+
+# table -> (columns, function inserting a batch)
+IMPORTERS = {
+    "users": (USER_COLUMNS, import_users),
+    "posts": (POST_COLUMNS, import_posts),
+}
+
+def import_lines(db, lines, batch_size=BATCH_SIZE, renumber=False):
+    # loads an export line by line, returns the number of rows added per table.
+    # Users and posts that already exist are skipped. Post ids are kept unless renumber
+    # is set; exports of sharded posts only have ids unique per wall, so they need
+    # renumbering when imported into a different number of shards
+    counts = {table: 0 for table in IMPORTERS}
+    table = None
+    batch = []
+
+    def flush():
+        if batch:
+            counts[table] += IMPORTERS[table][1](db, batch, renumber)
+            batch.clear()
+
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        record = json.loads(line)
+        if record.get("table") not in IMPORTERS:
+            raise ValueError(f"line {number}: unknown table {record.get('table')!r}")
+        if record["table"] != table or len(batch) >= batch_size:
+            flush()
+            table = record["table"]
+        batch.append(tuple(record["row"][column] for column in IMPORTERS[table][0]))
+    flush()
+    return counts
@@ -0,0 +1,35 @@
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# gzip is always available, brotli only when the brotli package is installed
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5 # fast enough to compress on the fly, static files use 11
+
+def negotiate(accept_encodings):
+    #the best encoding the client accepts, None means send it uncompressed
+    return accept_encodings.best_match(ENCODINGS)
+
+def compress_stream(chunks, encoding):
+    #compresses an iterable of str/bytes chunks incrementally, memory stays at one chunk
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        compress, finish = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31) # wbits 31 writes a gzip header
+        compress, finish = compressor.compress, compressor.flush
+    for chunk in chunks:
+        data = compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield finish()
+
+def compress(data, encoding, best=False):
+    if encoding == "br":
+        return brotli.compress(data, quality=11 if best else BROTLI_QUALITY)
+    compressor = zlib.compressobj(9 if best else GZIP_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
@@ -3,20 +3,266 @@ from flask import g
 import os
 import sys
 import random
+import time
+import threading
+import queue
+import zlib
+from collections import OrderedDict
 
 DATABASE = "database.db"
+MESSAGE_PAGE_SIZE = 50 # default number of posts returned per wall page
+MAX_MESSAGE_PAGE_SIZE = 200
+SEARCH_PAGE_SIZE = 20 # default number of search results per page
+TOP_POSTERS = 5 # posters listed in the stats of a wall
+SEARCH_REBUILD_BATCH_SIZE = 5000 # posts indexed per transaction by rebuild_search_index
+EXPORT_FETCH_SIZE = 1000 # rows fetched at a time when streaming whole tables
+SESSION_TTL = int(os.environ.get("TWIDDER_SESSION_TTL", 24 * 60 * 60)) # seconds a token stays valid
+SESSION_REAP_BATCH_SIZE = 500 # expired sessions deleted per transaction by the reaper
+POOL_SIZE = int(os.environ.get("TWIDDER_POOL_SIZE", 8)) # idle connections kept open for reuse
+STATEMENT_CACHE_SIZE = 256 # prepared statements kept per connection
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL", # readers no longer wait for writers
+    "PRAGMA synchronous=NORMAL", # in WAL mode only checkpoints fsync
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-16000", # 16 MB page cache per connection
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+)
+# Posts, wall versions and the search index can be split over POST_SHARDS files by a hash
+# of the wall (SENT_TO), so writers on different shards don't queue for one write lock.
+# Users and sessions always stay in DATABASE, which every shard connection attaches.
+POST_SHARDS = int(os.environ.get("TWIDDER_POST_SHARDS", 0)) # 0 keeps the posts in DATABASE
+RESHARD_BATCH_SIZE = 5000 # posts copied per transaction by reshard_posts
+PREFIXES_STRIPPED_VERSION = 1 # PRAGMA user_version of a database whose posts strip_sender_prefixes has fixed
+SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema.sql")
+CACHE_TTL = int(os.environ.get("TWIDDER_CACHE_TTL", 30)) # seconds a cached token or profile is trusted
+CACHE_SIZE = int(os.environ.get("TWIDDER_CACHE_SIZE", 10000)) # max entries per cache
+
+MISSING = object()
+
+class TTLCache:
+    # small thread safe LRU cache whose entries also expire after ttl seconds.
+    # other worker processes do not see our invalidations, so the ttl bounds
+    # how long they can serve a stale entry
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self.data[key]
+                self.misses += 1
+                return MISSING
+            self.data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + self.ttl)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.data)}
+
+# session entries are (email, token, expires_at) stored under both "e:<email>" and "t:<token>"
+session_cache = TTLCache()
+# user profiles by email, only existing users are cached
+user_cache = TTLCache()
+# functions called with (email, token) after this process changed or removed a session, so
+# other processes can drop their cached copy. The shared session registry publishes them
+session_listeners = []
+
+def cache_stats():
+    return {"session": session_cache.stats(), "user": user_cache.stats()}
+
+def cache_session(email, token, expires_at):
+    entry = (email, token, expires_at)
+    session_cache.set("e:" + email, entry)
+    session_cache.set("t:" + token, entry)
+
+def invalidate_session(email=None, token=None, notify=True):
+    if email is not None:
+        session_cache.invalidate("e:" + email)
+    if token is not None:
+        session_cache.invalidate("t:" + token)
+    if notify:
+        for listener in session_listeners:
+            listener(email, token)
+
+def cached_session(key):
+    #returns the cached session entry, None when it is known to be expired or MISSING
+    entry = session_cache.get(key)
+    if entry is MISSING:
+        return MISSING
+    if entry[2] <= time.time():
+        return None
+    return entry
+
+def connect(database=None, accounts=None):
+    db = sqlite3.connect(database or DATABASE, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+    for pragma in CONNECTION_PRAGMAS:
+        db.execute(pragma)
+    if accounts is not None:
+        #a shard has no users table of its own, unqualified names fall through to the attached one
+        db.execute("ATTACH DATABASE ? AS accounts", (accounts,))
+    return db
+
+class ConnectionPool:
+    # keeps up to size configured connections open so requests reuse them together
+    # with their prepared statement cache, extra connections are opened on demand
+    # when the pool is empty and closed again on release
+    def __init__(self, database, size=POOL_SIZE, accounts=None):
+        self.database = database
+        self.size = size
+        self.accounts = accounts
+        self.idle = queue.LifoQueue()
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return connect(self.database, self.accounts)
+
+    def release(self, db):
+        if db.in_transaction:
+            db.rollback()
+        if self.idle.qsize() < self.size:
+            self.idle.put(db)
+        else:
+            db.close()
+
+    def close_all(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+pool = None
+pool_lock = threading.Lock()
+
+def get_pool():
+    global pool
+    with pool_lock:
+        if pool is None or pool.database != DATABASE:
+            if pool is not None:
+                pool.close_all()
+            pool = ConnectionPool(DATABASE)
+        return pool
 
 def get_db():
     db = getattr(g, "db", None)
     if db is None:
-        db = g.db = sqlite3.connect(DATABASE)
+        db = g.db = get_pool().acquire()
     return g.db
 
-def close_db():
-    db = getattr(g, "db", None)
+def close_db(e=None):
+    #registered as app teardown, hands the connections of this app context back to their pools
+    db = g.pop("db", None)
     if db is not None:
-        db.close()
-        db = None
+        get_pool().release(db)
+    for (shard, accounts), db in g.pop("shard_dbs", {}).items():
+        get_shard_pool(shard, accounts).release(db)
+
+def shard_of(email, shards=None):
+    # the shard holding the wall of email, None when the posts are not sharded
+    shards = POST_SHARDS if shards is None else shards
+    if not shards:
+        return None
+    return zlib.crc32(email.encode('utf-8')) % shards
+
+def shard_path(shard, shards=None):
+    #the shard count is part of the name, so reshard_posts never writes into a file it reads
+    shards = shards or POST_SHARDS
+    return os.path.join(os.path.dirname(DATABASE), f"posts-{shards}-{shard}.db")
+
+initialized_shards = set()
+shard_lock = threading.Lock()
+
+def init_shard(path):
+    # creates the tables of a shard from schema.sql, without users and session which
+    # stay in DATABASE. Runs without accounts attached so the drops can't reach it
+    with shard_lock:
+        if path in initialized_shards:
+            return
+        db = sqlite3.connect(path)
+        try:
+            with open(SCHEMA) as f:
+                db.executescript(f.read())
+            db.executescript("DROP TABLE IF EXISTS main.session; DROP TABLE IF EXISTS main.users;")
+        finally:
+            db.close()
+        initialized_shards.add(path)
+
+def connect_shard(shard, shards=None, accounts=True):
+    # a new connection to the posts of shard, to DATABASE when shard is None. Only reads
+    # joining users need DATABASE attached as accounts: BEGIN IMMEDIATE takes the write lock
+    # of every attached database, so connections that write posts go without it or every
+    # shard would queue on the lock of DATABASE
+    if shard is None:
+        return connect()
+    path = shard_path(shard, shards)
+    init_shard(path)
+    return connect(path, DATABASE if accounts else None)
+
+shard_pools = {} # (path, accounts) -> ConnectionPool
+
+def get_shard_pool(shard, accounts=True):
+    path = shard_path(shard)
+    attached = DATABASE if accounts else None
+    with pool_lock:
+        shard_pool = shard_pools.get((path, accounts))
+        if shard_pool is None or shard_pool.accounts != attached:
+            if shard_pool is not None:
+                shard_pool.close_all()
+            init_shard(path)
+            shard_pool = shard_pools[(path, accounts)] = ConnectionPool(path, accounts=attached)
+        return shard_pool
+
+def get_shard_db(shard, accounts=True):
+    if shard is None:
+        return get_db()
+    shard_dbs = g.setdefault("shard_dbs", {})
+    db = shard_dbs.get((shard, accounts))
+    if db is None:
+        db = shard_dbs[(shard, accounts)] = get_shard_pool(shard, accounts).acquire()
+    return db
+
+def get_posts_db(email):
+    # connection of this app context to the database holding the wall of email
+    return get_shard_db(shard_of(email))
+
+def posts_dbs():
+    # every database holding posts, for maintenance commands that visit all of them
+    if not POST_SHARDS:
+        return [get_db()]
+    return [get_shard_db(shard) for shard in range(POST_SHARDS)]
+
+def posts_by_shard(rows, wall_index, shards=None):
+    # groups rows by the shard of the wall in row[wall_index] as {shard: [(position, row)]}
+    groups = {}
+    for position, row in enumerate(rows):
+        groups.setdefault(shard_of(row[wall_index], shards), []).append((position, row))
+    return groups
 
 def add_user(user):
     db = get_db()
@@ -35,14 +281,48 @@ def add_user(user):
         return False  
 
 
+def add_users(db, rows):
+    # bulk insert of (email, password, firstname, lastname, gender, city, country) rows in one
+    # transaction, emails that are already taken are skipped. Returns the number of new users
+    cursor = db.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.executemany(
+            "INSERT OR IGNORE INTO users (email, password, firstname, lastname, gender, city, country) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+        added = cursor.rowcount
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    for row in rows:
+        user_cache.invalidate(row[0])
+    return added
+
+
+def iterUsers(db):
+    # every user as an (email, password, firstname, lastname, gender, city, country) row
+    cursor = db.cursor()
+    cursor.execute("SELECT email, password, firstname, lastname, gender, city, country FROM users ORDER BY email")
+    while True:
+        rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+        if not rows:
+            return
+        yield from rows
+
+
 def getUserDataByEmail(email):
+    cached = user_cache.get(email)
+    if cached is not MISSING:
+        return dict(cached)
     db = get_db()
     cursor = db.cursor()
     cursor.execute("SELECT firstname, lastname, gender, city, country, email, password FROM users WHERE email=?", (email,))
     data = cursor.fetchone()
     
     if data is not None:
-        return {
+        user = {
            "firstname": data[0],
             "lastname": data[1],
             "gender": data[2],
@@ -50,6 +330,8 @@ def getUserDataByEmail(email):
             "country": data[4],
             "email": data[5],
         }
+        user_cache.set(email, user)
+        return dict(user)
     else:
         return None 
     
@@ -77,26 +359,25 @@ def authenticate_user(email, password):
 def add_session(email, token):
     db = get_db()
     cursor = db.cursor()
-    
-   
-    cursor.execute("SELECT email FROM session WHERE email = ?", (email,))
+    cursor.execute("SELECT token FROM session WHERE email=?", (email,))
     existing = cursor.fetchone()
-    
-    if existing:
-        
-        cursor.execute("UPDATE session SET token = ? WHERE email = ?", (token, email))
-    else:
-        
-        cursor.execute("INSERT INTO session (email, token) VALUES (?, ?)", (email, token))
-    
+    expires_at = int(time.time()) + SESSION_TTL
+    cursor.execute(
+        "INSERT INTO session (email, token, expires_at) VALUES (?, ?, ?) "
+        "ON CONFLICT(email) DO UPDATE SET token=excluded.token, expires_at=excluded.expires_at",
+        (email, token, expires_at)
+    )
     db.commit()
+    #drop the previous token of this user from the caches once the new one is stored
+    invalidate_session(email, existing[0] if existing else None)
+    cache_session(email, token, expires_at)
     return True
 
 
 def token_exists(token):
     db = get_db()
     cursor = db.cursor()
-    cursor.execute("SELECT token FROM session WHERE token=?", (token,))
+    cursor.execute("SELECT token FROM session WHERE token=? AND expires_at>?", (token, int(time.time())))
     data = cursor.fetchone()
     if data is not None:
         return True
@@ -106,7 +387,7 @@ def token_exists(token):
 def emailInSession(email):
     db = get_db()
     cursor = db.cursor()
-    cursor.execute("SELECT email FROM session WHERE email=?", (email,))
+    cursor.execute("SELECT email FROM session WHERE email=? AND expires_at>?", (email, int(time.time())))
     data = cursor.fetchone()
     if data is not None:
         return True
@@ -114,65 +395,436 @@ def emailInSession(email):
         return False
     
 def check_email(email):
-    db = get_db()
-    cursor = db.cursor()
-    cursor.execute("SELECT email FROM users WHERE email=?", (email,))
-    data = cursor.fetchone()
-    return data
+    #goes through the profile lookup so a registered email warms the user cache
+    if getUserDataByEmail(email) is None:
+        return None
+    return (email,)
 
 def delete_session(token):
     db = get_db()
     cursor = db.cursor()
-    cursor.execute("DELETE FROM session WHERE token=?", (token,))
+    cursor.execute("DELETE FROM session WHERE token=? RETURNING email", (token,))
+    deleted = cursor.fetchone()
     db.commit()
+    invalidate_session(deleted[0] if deleted else None, token)
     return True
 
 def getEmailByToken(token):
+    cached = cached_session("t:" + token)
+    if cached is not MISSING:
+        return cached[0] if cached else None
     db = get_db()
     cursor = db.cursor()
-    cursor.execute("SELECT email FROM session WHERE token=?", (token,))
+    cursor.execute("SELECT email, expires_at FROM session WHERE token=? AND expires_at>?", (token, int(time.time())))
     data = cursor.fetchone()
     if data is not None:
+        cache_session(data[0], token, data[1])
         return data[0]
     else:
         return None
     
 def getTokenByEmail(email):
+    cached = cached_session("e:" + email)
+    if cached is not MISSING:
+        return cached[1] if cached else None
     db = get_db()
     cursor = db.cursor()
-    cursor.execute("SELECT token FROM session WHERE email=?", (email,))
+    cursor.execute("SELECT token, expires_at FROM session WHERE email=? AND expires_at>?", (email, int(time.time())))
     data = cursor.fetchone()
     if data is not None:
+        cache_session(email, data[0], data[1])
         return data[0]
     else:
         return None
       
+def delete_expired_sessions(batch_size=SESSION_REAP_BATCH_SIZE):
+    # delete expired sessions in small batches so the reaper never holds the
+    # write lock for long, returns the emails whose session was removed
+    db = get_db()
+    cursor = db.cursor()
+    expired = []
+    while True:
+        cursor.execute(
+            "DELETE FROM session WHERE rowid IN "
+            "(SELECT rowid FROM session WHERE expires_at<=? LIMIT ?) RETURNING email",
+            (int(time.time()), batch_size)
+        )
+        batch = [row[0] for row in cursor.fetchall()]
+        db.commit()
+        #cached entries carry expires_at and already count as expired in every process
+        for email in batch:
+            invalidate_session(email, notify=False)
+        expired.extend(batch)
+        if len(batch) < batch_size:
+            return expired
+
 def change_password(email, password):
     db = get_db()
     cursor = db.cursor()
     cursor.execute("UPDATE users SET password=? WHERE email=?", (password, email))
     db.commit()
+    user_cache.invalidate(email)
     return True
 
-def getMessagesByEmail(email):
-    db = get_db()
+# posts store the raw text, the sender's name is joined from users when the wall is read
+MESSAGE_SELECT = (
+    "SELECT posts.SENT_BY, posts.SENT_TO, posts.POST, posts.POST_ID, users.firstname, users.lastname "
+    "FROM posts LEFT JOIN users ON users.email=posts.SENT_BY "
+)
+
+def message_from_row(row):
+    return {
+        "sent_by": row[0],
+        "sent_to": row[1],
+        "post": row[2],
+        "post_id": row[3],
+        "sender": {"firstname": row[4], "lastname": row[5]},
+    }
+
+def getMessagesByEmail(email, before_id=None, limit=MESSAGE_PAGE_SIZE):
+    return list(iterMessagesByEmail(email, before_id, limit))
+
+
+def iterMessagesByEmail(email, before_id=None, limit=MESSAGE_PAGE_SIZE):
+    # keyset pagination: newest posts first, walking backwards from before_id
+    # so the cost only depends on the page size and not on the wall size.
+    # Rows are yielded straight from the cursor so callers can stream them
+    db = get_posts_db(email)
+    cursor = db.cursor()
+    limit = max(1, min(limit, MAX_MESSAGE_PAGE_SIZE))
+    if before_id is None:
+        cursor.execute(
+            MESSAGE_SELECT + "WHERE posts.SENT_TO=? ORDER BY posts.POST_ID DESC LIMIT ?",
+            (email, limit)
+        )
+    else:
+        cursor.execute(
+            MESSAGE_SELECT + "WHERE posts.SENT_TO=? AND posts.POST_ID<? ORDER BY posts.POST_ID DESC LIMIT ?",
+            (email, before_id, limit)
+        )
+    for row in cursor:
+        yield message_from_row(row)
+
+
+def getMessagesSince(email, after_id, limit=MAX_MESSAGE_PAGE_SIZE):
+    # posts newer than after_id, oldest first, used to resync a reconnecting websocket
+    db = get_posts_db(email)
+    cursor = db.cursor()
+    cursor.execute(
+        MESSAGE_SELECT + "WHERE posts.SENT_TO=? AND posts.POST_ID>? ORDER BY posts.POST_ID LIMIT ?",
+        (email, after_id, limit)
+    )
+    messages = []
+    for row in cursor.fetchall():
+        messages.append(message_from_row(row))
+    return messages
+
+
+def search_query(text):
+    # turns the user's words into an fts5 query where every word has to match, a word
+    # ending in * matches as a prefix. Quoting each word keeps fts5 syntax out of user input
+    terms = []
+    for word in text.split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*").replace('"', '""')
+        if word:
+            terms.append(f'"{word}"' + ("*" if prefix else ""))
+    return " AND ".join(terms)
+
+def searchMessages(email, text, limit=SEARCH_PAGE_SIZE, offset=0):
+    # best matching posts on the wall of email first, None when text has no words
+    query = search_query(text)
+    if not query:
+        return None
+    db = get_posts_db(email)
     cursor = db.cursor()
-    cursor.execute("SELECT SENT_BY, SENT_TO, POST FROM posts WHERE SENT_TO=?", (email,))
-    data = cursor.fetchall()
+    limit = max(1, min(limit, MAX_MESSAGE_PAGE_SIZE))
+    #the wall column holds hex(SENT_TO), so fts5 itself narrows the matches down to this wall
+    wall = email.encode('utf-8').hex().upper()
+    cursor.execute(
+        MESSAGE_SELECT.replace("FROM posts ", "FROM posts_search JOIN posts ON posts.POST_ID=posts_search.rowid ")
+        + "WHERE posts_search MATCH ? AND posts.SENT_TO=? ORDER BY bm25(posts_search, 1.0, 0.0) LIMIT ? OFFSET ?",
+        (f'wall : "{wall}" AND ({query})', email, limit, max(0, offset))
+    )
     messages = []
-    for row in data:
-        messages.append({
-            "sent_by": row[0],
-            "sent_to": row[1],
-            "post": row[2],
-        })
+    for row in cursor.fetchall():
+        messages.append(message_from_row(row))
     return messages
 
 
+def rebuild_search_index(db, batch_size=SEARCH_REBUILD_BATCH_SIZE):
+    # refills posts_search from posts, for databases created before the index existed.
+    # Runs in batches, posts written after the index was emptied are indexed by the triggers
+    cursor = db.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    cursor.execute("INSERT INTO posts_search (posts_search) VALUES ('delete-all')")
+    cursor.execute("SELECT COALESCE(MAX(POST_ID), 0) FROM posts")
+    max_id = cursor.fetchone()[0]
+    db.commit()
+    last_id = 0
+    indexed = 0
+    while last_id < max_id:
+        cursor.execute(
+            "SELECT MAX(POST_ID), COUNT(*) FROM (SELECT POST_ID FROM posts WHERE POST_ID>? AND POST_ID<=? ORDER BY POST_ID LIMIT ?)",
+            (last_id, max_id, batch_size)
+        )
+        batch_end, count = cursor.fetchone()
+        if not count:
+            break
+        cursor.execute(
+            "INSERT INTO posts_search (rowid, POST, wall) "
+            "SELECT POST_ID, POST, hex(SENT_TO) FROM posts WHERE POST_ID>? AND POST_ID<=?",
+            (last_id, batch_end)
+        )
+        db.commit()
+        indexed += count
+        last_id = batch_end
+    return indexed
+
+
+def iterPosts(db):
+    # every post as a (post_id, sent_by, sent_to, post) row, oldest first
+    cursor = db.cursor()
+    cursor.execute("SELECT POST_ID, SENT_BY, SENT_TO, POST FROM posts ORDER BY POST_ID")
+    while True:
+        rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+        if not rows:
+            return
+        yield from rows
+
+
+def getUserStats(email, top=TOP_POSTERS):
+    # posts received and sent by email and who posts the most on their wall, read from the
+    # counters the posts triggers maintain, so the cost does not grow with the posts
+    wall_db = get_posts_db(email)
+    received = 0
+    sent = 0
+    #posts are stored with their wall, so what a user sent is spread over every shard
+    for db in posts_dbs():
+        cursor = db.cursor()
+        cursor.execute("SELECT received, sent FROM post_stats WHERE email=?", (email,))
+        data = cursor.fetchone()
+        if data is not None:
+            sent += data[1]
+            if db is wall_db:
+                received = data[0]
+    cursor = wall_db.cursor()
+    cursor.execute(
+        "SELECT wall_posters.poster, wall_posters.posts, users.firstname, users.lastname "
+        "FROM wall_posters LEFT JOIN users ON users.email=wall_posters.poster "
+        "WHERE wall_posters.wall=? ORDER BY wall_posters.posts DESC LIMIT ?",
+        (email, top)
+    )
+    top_posters = []
+    for row in cursor.fetchall():
+        top_posters.append({"email": row[0], "posts": row[1], "firstname": row[2], "lastname": row[3]})
+    return {"email": email, "received": received, "sent": sent, "top_posters": top_posters}
+
+
+def recompute_stats(db):
+    # rebuilds post_stats and wall_posters from the posts, repairs counters that drifted or
+    # were never filled for posts written before the triggers existed. Returns the number of walls
+    cursor = db.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute("DELETE FROM post_stats")
+        cursor.execute("DELETE FROM wall_posters")
+        cursor.execute(
+            "INSERT INTO wall_posters (wall, poster, posts) "
+            "SELECT SENT_TO, SENT_BY, COUNT(*) FROM posts GROUP BY SENT_TO, SENT_BY"
+        )
+        cursor.execute(
+            "INSERT INTO post_stats (email, received, sent) "
+            "SELECT email, SUM(received), SUM(sent) FROM ("
+            "SELECT wall AS email, posts AS received, 0 AS sent FROM wall_posters "
+            "UNION ALL SELECT poster, 0, posts FROM wall_posters) GROUP BY email"
+        )
+        cursor.execute("SELECT COUNT(DISTINCT wall) FROM wall_posters")
+        walls = cursor.fetchone()[0]
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return walls
+
+
+def getWallVersion(email):
+    # the version of a wall grows with every post on it, 0 for walls never posted to since versioning
+    db = get_posts_db(email)
+    cursor = db.cursor()
+    cursor.execute("SELECT version FROM wall_versions WHERE email=?", (email,))
+    data = cursor.fetchone()
+    if data is not None:
+        return data[0]
+    else:
+        return 0
+
+
+def insert_posts(db, rows):
+    # inserts the (sent_by, sent_to, post) rows and bumps their wall versions in a single
+    # transaction, returns the new post ids in the order of rows
+    cursor = db.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        #we hold the write lock, so AUTOINCREMENT hands out the ids following the current sequence
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name='posts'")
+        data = cursor.fetchone()
+        first_id = (data[0] if data is not None else 0) + 1
+        cursor.executemany("INSERT INTO posts (SENT_BY, SENT_TO, POST) VALUES (?, ?, ?)", rows)
+        bump_wall_versions(cursor, [row[1] for row in rows])
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return list(range(first_id, first_id + len(rows)))
+
+
+def import_posts(db, rows):
+    # inserts (post_id, sent_by, sent_to, post) rows keeping their ids, like insert_posts the
+    # walls get a new version in the same transaction. Ids that already exist are skipped,
+    # returns the number of posts imported
+    cursor = db.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.executemany("INSERT OR IGNORE INTO posts (POST_ID, SENT_BY, SENT_TO, POST) VALUES (?, ?, ?, ?)", rows)
+        imported = cursor.rowcount
+        bump_wall_versions(cursor, [row[2] for row in rows])
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return imported
+
+
+def bump_wall_versions(cursor, walls):
+    #one new version per wall is enough to invalidate cached pages, however many posts it got
+    cursor.executemany(
+        "INSERT INTO wall_versions (email, version) VALUES (?, 1) "
+        "ON CONFLICT(email) DO UPDATE SET version=version+1",
+        [(wall,) for wall in dict.fromkeys(walls)]
+    )
+
+
+def add_posts(rows):
+    # insert_posts for (sent_by, sent_to, post) rows of any walls, one transaction per shard.
+    # Returns the new post ids in the order of rows
+    post_ids = [None] * len(rows)
+    for shard, items in posts_by_shard(rows, 1).items():
+        shard_ids = insert_posts(get_shard_db(shard, accounts=False), [row for position, row in items])
+        for (position, row), post_id in zip(items, shard_ids):
+            post_ids[position] = post_id
+    return post_ids
+
+
+def restore_posts(rows):
+    # import_posts for (post_id, sent_by, sent_to, post) rows of any walls
+    imported = 0
+    for shard, items in posts_by_shard(rows, 2).items():
+        imported += import_posts(get_shard_db(shard, accounts=False), [row for position, row in items])
+    return imported
+
+
 def add_message(sent_by, sent_to, post):
-    db = get_db()
+    # returns the id of the new post, the wall version is bumped in the same transaction
+    return add_posts([(sent_by, sent_to, post)])[0]
+
+
+def migrate_schema(db):
+    # brings a database created by an older schema.sql up to date and returns what it did.
+    # schema.sql only has CREATE ... IF NOT EXISTS, which leaves old tables as they are and
+    # then fails on indexes over the missing columns, so those are added here first. Tables
+    # the schema adds next to existing posts are filled right away: the triggers on posts
+    # expect the search index and the counters to already hold every post
     cursor = db.cursor()
-    cursor.execute("INSERT INTO posts (SENT_BY, SENT_TO, POST) VALUES (?, ?, ?)", (sent_by, sent_to, post))
+    changes = []
+    cursor.execute("SELECT name FROM pragma_table_info('session')")
+    columns = [row[0] for row in cursor.fetchall()]
+    if columns and "expires_at" not in columns:
+        cursor.execute("ALTER TABLE session ADD COLUMN expires_at INTEGER NOT NULL DEFAULT 0")
+        #sessions from before expiry get a full lifetime starting now
+        cursor.execute("UPDATE session SET expires_at=?", (int(time.time()) + SESSION_TTL,))
+        changes.append("added session.expires_at")
     db.commit()
-    return True
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name IN ('posts', 'posts_search', 'post_stats')")
+    tables = {row[0] for row in cursor.fetchall()}
+    with open(SCHEMA) as f:
+        db.executescript(f.read())
+    if "posts" in tables and "posts_search" not in tables:
+        changes.append(f"indexed {rebuild_search_index(db)} posts for search")
+    if "posts" in tables and "post_stats" not in tables:
+        changes.append(f"counted the posts of {recompute_stats(db)} walls")
+    return changes
+
 
+def strip_sender_prefixes(db):
+    # one shot migration for posts written before the sender name was joined at read time,
+    # they start with "Me: " or "<firstname> <lastname>: ". Running it twice would strip too
+    # much, so the database is marked through its user_version and a second run refused
+    cursor = db.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute("PRAGMA user_version")
+        if cursor.fetchone()[0] >= PREFIXES_STRIPPED_VERSION:
+            raise ValueError("The sender prefixes were already stripped from these posts")
+        cursor.execute("UPDATE posts SET POST=substr(POST, 5) WHERE SENT_BY=SENT_TO AND substr(POST, 1, 4)='Me: '")
+        stripped = cursor.rowcount
+        cursor.execute(
+            "UPDATE posts SET POST=substr(POST, length(sender.prefix) + 1) "
+            "FROM (SELECT email, firstname || ' ' || lastname || ': ' AS prefix FROM users) AS sender "
+            "WHERE sender.email=posts.SENT_BY AND posts.SENT_BY!=posts.SENT_TO "
+            "AND substr(posts.POST, 1, length(sender.prefix))=sender.prefix"
+        )
+        stripped += cursor.rowcount
+        #the walls changed, so cached copies must not be revalidated
+        cursor.execute(
+            "INSERT INTO wall_versions (email, version) SELECT DISTINCT SENT_TO, 1 FROM posts WHERE true "
+            "ON CONFLICT(email) DO UPDATE SET version=version+1"
+        )
+        cursor.execute(f"PRAGMA user_version={PREFIXES_STRIPPED_VERSION}")
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return stripped
+
+
+def reshard_posts(target_shards, source_shards=None, batch_size=RESHARD_BATCH_SIZE):
+    # copies all posts from source_shards files (default the current POST_SHARDS, 0 for
+    # DATABASE) into target_shards files. Posts get new ids in their new file, the order of
+    # every wall is kept and ids only have to be unique per wall. Wall versions continue
+    # above the old ones so no cached page validates against a renumbered wall.
+    # The sources are left as they are, run it while the server is stopped
+    source_shards = POST_SHARDS if source_shards is None else source_shards
+    if source_shards == target_shards:
+        raise ValueError("The posts are already stored in that many shards")
+    targets = [connect_shard(shard, target_shards, accounts=False) for shard in range(target_shards)] or [connect()]
+    sources = [connect_shard(shard, source_shards, accounts=False) for shard in range(source_shards)] or [connect()]
+    copied = 0
+    try:
+        for target in targets:
+            if target.execute("SELECT EXISTS (SELECT 1 FROM main.posts)").fetchone()[0]:
+                raise ValueError("The target database already holds posts")
+        for source in sources:
+            cursor = source.cursor()
+            cursor.execute("SELECT SENT_BY, SENT_TO, POST FROM main.posts ORDER BY POST_ID")
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for shard, items in posts_by_shard(rows, 1, target_shards).items():
+                    insert_posts(targets[shard or 0], [row for position, row in items])
+                copied += len(rows)
+            cursor.execute("SELECT email, version FROM main.wall_versions")
+            versions = cursor.fetchall()
+            for shard, items in posts_by_shard(versions, 0, target_shards).items():
+                target = targets[shard or 0]
+                target.executemany(
+                    "INSERT INTO main.wall_versions (email, version) VALUES (?, ?) "
+                    "ON CONFLICT(email) DO UPDATE SET version=version+excluded.version",
+                    [row for position, row in items]
+                )
+                target.commit()
+    finally:
+        for db in targets + sources:
+            db.close()
+    return copied
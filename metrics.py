@@ -0,0 +1,271 @@
+import functools
+import inspect
+import os
+import threading
+import time
+from flask import g, has_app_context, request
+
+# Per-request instrumentation exposed in the Prometheus text format on /metrics. Every
+# worker process keeps its own numbers, so scrape each worker separately.
+# Requests slower than TWIDDER_SLOW_REQUEST_MS (0 disables the log) are logged together
+# with the time they spent in database_helper, in bcrypt and elsewhere.
+SLOW_REQUEST_MS = float(os.environ.get("TWIDDER_SLOW_REQUEST_MS", 0))
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+UNTIMED_ROUTES = ("/ws",) # a websocket "request" lasts as long as the connection
+
+# database_helper functions that are not database round trips of their own
+UNTIMED_HELPERS = (
+    "connect", "get_pool", "get_db", "close_db", "cache_stats", "cache_session",
+    "invalidate_session", "cached_session", "message_from_row", "shard_of", "shard_path",
+    "init_shard", "connect_shard", "get_shard_pool", "get_shard_db", "get_posts_db", "posts_dbs",
+    "posts_by_shard",
+)
+
+class Histogram:
+    def __init__(self, name, help, buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.labels = labels
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for label_values, (counts, total, count) in sorted(self.series.items()):
+                labels = format_labels(self.labels, label_values)
+                for bound, bucket in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{{{labels}{"," if labels else ""}le="{bound}"}} {bucket}')
+                lines.append(f'{self.name}_bucket{{{labels}{"," if labels else ""}le="+Inf"}} {count}')
+                lines.append(f"{self.name}_sum{braced(labels)} {total}")
+                lines.append(f"{self.name}_count{braced(labels)} {count}")
+        return lines
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, *label_values):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{braced(format_labels(self.labels, label_values))} {value}")
+        return lines
+
+def format_labels(names, values):
+    return ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+
+def braced(labels):
+    return "{" + labels + "}" if labels else ""
+
+request_duration = Histogram("twidder_request_duration_seconds", "Request latency by route", LATENCY_BUCKETS, ("route", "method", "status"))
+request_queries = Histogram("twidder_request_sqlite_queries", "SQLite statements executed per request", QUERY_BUCKETS, ("route",))
+request_commits = Counter("twidder_sqlite_commits_total", "SQLite commits issued by requests", ("route",))
+request_db_seconds = Counter("twidder_db_seconds_total", "Time spent in database_helper by route", ("route",))
+helper_calls = Counter("twidder_db_helper_calls_total", "Calls of database_helper functions", ("function",))
+sqlite_statements = Counter("twidder_sqlite_statements_total", "SQLite statements executed by any connection")
+bcrypt_duration = Histogram("twidder_bcrypt_duration_seconds", "Time a request waited for a bcrypt hash or check", LATENCY_BUCKETS)
+bcrypt_rejected = Counter("twidder_bcrypt_rejected_total", "Hashes rejected because the bcrypt pool was saturated")
+websockets_rejected = Counter("twidder_websockets_rejected_total", "Websockets turned away because the worker was at capacity")
+websockets_evicted = Counter("twidder_websockets_evicted_total", "Websockets closed by the server for missing a heartbeat or never signing in", ("reason",))
+rate_limited = Counter("twidder_rate_limited_total", "Requests rejected by the rate limiter", ("route",))
+
+gauges = {} # name -> (help, callable returning the current value)
+worker_stats = threading.local() # stats of threads outside any request, like the post writer
+
+class RequestStats:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.commits = 0
+        self.db_time = 0.0
+        self.bcrypt_time = 0.0
+        self.depth = 0
+        self.failed = False # the body failed after the status was sent
+
+def current_stats():
+    if not has_app_context():
+        return getattr(worker_stats, "stats", None)
+    return g.get("request_stats")
+
+def attribute_batch(batch_stats, requests, waited):
+    #work a background thread did for several waiting requests, split evenly between them.
+    #The time they waited for it counts as their database time
+    stats = current_stats()
+    if stats is None:
+        return
+    stats.queries += batch_stats.queries / requests
+    stats.commits += batch_stats.commits / requests
+    stats.db_time += waited
+
+def trace_statement(statement):
+    sqlite_statements.inc()
+    stats = current_stats()
+    if stats is not None:
+        stats.queries += 1
+        if statement.lstrip().upper().startswith("COMMIT"):
+            stats.commits += 1
+
+def timed_generator(fn):
+    #a generator helper does its cursor work while it is iterated, so every step is timed
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        helper_calls.inc(1, fn.__name__)
+        generator = fn(*args, **kwargs)
+        try:
+            while True:
+                stats = current_stats()
+                if stats is not None:
+                    stats.depth += 1
+                    start = time.perf_counter()
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    return
+                finally:
+                    if stats is not None:
+                        stats.depth -= 1
+                        if stats.depth == 0:
+                            stats.db_time += time.perf_counter() - start
+                yield item
+        finally:
+            generator.close()
+    return wrapper
+
+def timed_helper(fn):
+    if inspect.isgeneratorfunction(fn):
+        return timed_generator(fn)
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        helper_calls.inc(1, fn.__name__)
+        stats = current_stats()
+        if stats is None:
+            return fn(*args, **kwargs)
+        #helpers call each other, only the outermost call adds to the db time
+        stats.depth += 1
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            stats.depth -= 1
+            if stats.depth == 0:
+                stats.db_time += time.perf_counter() - start
+    return wrapper
+
+def instrument_database_helper(database_helper):
+    connect = database_helper.connect
+
+    @functools.wraps(connect)
+    def traced_connect(*args, **kwargs):
+        db = connect(*args, **kwargs)
+        db.set_trace_callback(trace_statement)
+        return db
+    database_helper.connect = traced_connect
+
+    for name, value in list(vars(database_helper).items()):
+        if callable(value) and getattr(value, "__module__", None) == database_helper.__name__ \
+                and not isinstance(value, type) and name not in UNTIMED_HELPERS:
+            setattr(database_helper, name, timed_helper(value))
+
+def instrument_password_hasher(password_hasher):
+    run = password_hasher.run
+
+    @functools.wraps(run)
+    def timed_run(*args):
+        start = time.perf_counter()
+        try:
+            return run(*args)
+        except password_hasher.HasherBusy:
+            bcrypt_rejected.inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            bcrypt_duration.observe(elapsed)
+            stats = current_stats()
+            if stats is not None:
+                stats.bcrypt_time += elapsed
+    password_hasher.run = timed_run
+
+def add_gauge(name, help, value):
+    gauges[name] = (help, value)
+
+def before_request():
+    g.request_stats = RequestStats()
+
+def stream_failed():
+    #a streamed body broke off, the request is recorded as a 500 whatever status was sent
+    stats = current_stats()
+    if stats is not None:
+        stats.failed = True
+
+def after_request(response):
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    stats = g.get("request_stats")
+    if stats is None or route in UNTIMED_ROUTES:
+        g.pop("request_stats", None)
+        return response
+    if response.is_streamed:
+        #the body is produced after this hook and still adds to the stats, so the request
+        #is recorded once the server closes the response
+        response.call_on_close(functools.partial(
+            record_request, stats, route, request.method, request.path, response.status_code
+        ))
+    else:
+        g.pop("request_stats")
+        record_request(stats, route, request.method, request.path, response.status_code)
+    return response
+
+def record_request(stats, route, method, path, status):
+    status = 500 if stats.failed else status
+    elapsed = time.perf_counter() - stats.start
+    request_duration.observe(elapsed, route, method, str(status))
+    request_queries.observe(stats.queries, route)
+    request_commits.inc(stats.commits, route)
+    request_db_seconds.inc(stats.db_time, route)
+    if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+        other = elapsed - stats.db_time - stats.bcrypt_time
+        print(
+            f"Slow request {method} {path} {status}: "
+            f"total {elapsed * 1000:.1f} ms, db {stats.db_time * 1000:.1f} ms "
+            f"({stats.queries:g} queries, {stats.commits:g} commits), bcrypt {stats.bcrypt_time * 1000:.1f} ms, "
+            f"other {other * 1000:.1f} ms"
+        )
+
+def render():
+    lines = []
+    for metric in (request_duration, request_queries, request_commits, request_db_seconds,
+                   helper_calls, sqlite_statements, bcrypt_duration, bcrypt_rejected,
+                   websockets_rejected, websockets_evicted, rate_limited):
+        lines.extend(metric.render())
+    for name, (help, value) in sorted(gauges.items()):
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value()}")
+    return "\n".join(lines) + "\n"
+
+def init_app(app, database_helper, password_hasher):
+    instrument_database_helper(database_helper)
+    instrument_password_hasher(password_hasher)
+    app.before_request(before_request)
+    app.after_request(after_request)
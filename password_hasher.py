@@ -0,0 +1,73 @@
+import multiprocessing
+import os
+import threading
+import bcrypt
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# bcrypt is CPU bound, so hashing runs in a process pool using every core instead
+# of on the request threads. A bounded number of hashes may be running or queued,
+# beyond that callers get HasherBusy right away and the server answers 503.
+# Workers are started from a fork server that only imports this module, never forked from
+# the server process with its threads. A pool that lost a worker is replaced on the next call.
+BCRYPT_LOG_ROUNDS = int(os.environ.get("TWIDDER_BCRYPT_ROUNDS", 12)) # work factor of new hashes
+HASH_WORKERS = int(os.environ.get("TWIDDER_HASH_WORKERS", os.cpu_count() or 1))
+HASH_QUEUE_SIZE = int(os.environ.get("TWIDDER_HASH_QUEUE_SIZE", HASH_WORKERS * 4)) # hashes allowed to wait for a worker
+HASH_RETRY_AFTER = 1 # seconds suggested to clients when the pool is saturated
+
+class HasherBusy(Exception):
+    pass
+
+executor = None
+executor_lock = threading.Lock()
+slots = threading.BoundedSemaphore(HASH_WORKERS + HASH_QUEUE_SIZE)
+
+def worker_context():
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    context = multiprocessing.get_context("forkserver")
+    #the default preloads __main__, which would set up the whole server in the fork server
+    context.set_forkserver_preload([__name__])
+    return context
+
+def get_executor():
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = ProcessPoolExecutor(max_workers=HASH_WORKERS, mp_context=worker_context())
+        return executor
+
+def reset_executor(broken):
+    #a worker died (OOM kill, segfault), the pool refuses all work from then on
+    global executor
+    with executor_lock:
+        if executor is broken:
+            executor = None
+    broken.shutdown(wait=False)
+
+def hash_password(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+def check_password(pw_hash, password):
+    return bcrypt.checkpw(password.encode('utf-8'), pw_hash.encode('utf-8'))
+
+def run(fn, *args):
+    #admission control: never wait for a slot, reject as soon as the queue is full
+    if not slots.acquire(blocking=False):
+        raise HasherBusy()
+    try:
+        pool = get_executor()
+        try:
+            return pool.submit(fn, *args).result()
+        except BrokenProcessPool:
+            print("bcrypt worker pool broke, starting a new one")
+            reset_executor(pool)
+            raise HasherBusy()
+    finally:
+        slots.release()
+
+def generate_password_hash(password, rounds=None):
+    return run(hash_password, password, rounds or BCRYPT_LOG_ROUNDS)
+
+def check_password_hash(pw_hash, password):
+    return run(check_password, pw_hash, password)
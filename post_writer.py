@@ -0,0 +1,115 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+import database_helper
+import metrics
+
+# Group commit for new posts: post_message threads queue their insert and wait, a single
+# writer thread takes everything that arrives within POST_BATCH_LINGER of the first post
+# (at most POST_BATCH_SIZE) and commits it as one transaction. Every request is answered
+# only after the transaction holding its post has committed. With sharded posts every
+# shard gets its own writer thread and connection, so their commits run in parallel.
+# The statements and commits of a batch are split between the requests it answers.
+GROUP_COMMIT = os.environ.get("TWIDDER_GROUP_COMMIT", "1") == "1"
+POST_BATCH_SIZE = int(os.environ.get("TWIDDER_POST_BATCH_SIZE", 64))
+POST_BATCH_LINGER = float(os.environ.get("TWIDDER_POST_BATCH_LINGER_MS", 2)) / 1000
+POST_WRITE_TIMEOUT = float(os.environ.get("TWIDDER_POST_WRITE_TIMEOUT", 30)) # seconds a request waits for its commit
+
+class PostWriter:
+    def __init__(self, shard=None, max_batch=POST_BATCH_SIZE, linger=POST_BATCH_LINGER):
+        self.shard = shard
+        self.max_batch = max_batch
+        self.linger = linger
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, sent_by, sent_to, post):
+        #blocks until the post is committed and returns its id
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        future = Future()
+        start = time.perf_counter()
+        self.queue.put(((sent_by, sent_to, post), future))
+        try:
+            post_id, batch_stats, batch_size = future.result(timeout=POST_WRITE_TIMEOUT)
+        except TimeoutError:
+            #the post may still be committed later, the writer is stuck or far behind
+            raise TimeoutError(f"The post was not committed within {POST_WRITE_TIMEOUT:g} seconds")
+        metrics.attribute_batch(batch_stats, batch_size, time.perf_counter() - start)
+        return post_id
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.linger
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self.queue.get(timeout=remaining))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def write_each(self, db, batch, batch_stats):
+        #one post per transaction, so a bad row only fails its own request. Returns how many were written
+        written = 0
+        for row, future in batch:
+            try:
+                post_id = database_helper.insert_posts(db, [row])[0]
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            future.set_result((post_id, batch_stats, len(batch)))
+            written += 1
+        return written
+
+    def run(self):
+        #a failed batch is retried post by post. When nothing could be written the connection
+        #is dropped and the next batch reconnects. The thread itself never dies, or every
+        #later post would wait for it forever
+        db = None
+        while True:
+            batch = self.next_batch()
+            batch_stats = metrics.worker_stats.stats = metrics.RequestStats()
+            try:
+                if db is None:
+                    db = database_helper.connect_shard(self.shard, accounts=False)
+                post_ids = database_helper.insert_posts(db, [row for row, future in batch])
+            except Exception as e:
+                print(f"Error writing a batch of {len(batch)} posts: {e}")
+                if db is not None and len(batch) > 1 and self.write_each(db, batch, batch_stats):
+                    continue
+                for row, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                if db is not None:
+                    try:
+                        db.close()
+                    except Exception:
+                        pass
+                    db = None
+                continue
+            for (row, future), post_id in zip(batch, post_ids):
+                future.set_result((post_id, batch_stats, len(batch)))
+
+writers = {} # shard -> PostWriter, None when the posts are not sharded
+writers_lock = threading.Lock()
+
+def get_writer(shard):
+    with writers_lock:
+        writer = writers.get(shard)
+        if writer is None:
+            writer = writers[shard] = PostWriter(shard)
+        return writer
+
+def add_message(sent_by, sent_to, post):
+    if not GROUP_COMMIT:
+        return database_helper.add_message(sent_by, sent_to, post)
+    return get_writer(database_helper.shard_of(sent_to)).submit(sent_by, sent_to, post)
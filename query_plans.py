@@ -0,0 +1,169 @@
+import ast
+import os
+import re
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import time
+
+import database_helper
+
+# Query plan regression check, run by `flask --app server check-query-plans`. Every SQL
+# literal passed to execute/executemany in database_helper.py is run through EXPLAIN QUERY
+# PLAN against two databases built from schema.sql, one with rows posts and one scale times
+# bigger. A plan that scans a whole hot table fails the check unless the statement belongs
+# to a maintenance function that has to visit every row. Each statement is also timed on
+# both databases, inside a transaction that is rolled back. A hot path statement that gets
+# slower by more than GROWTH_LIMIT of the size ratio fails as well: a range search that
+# matches most of the table (expires_at>? instead of token=?) is a scan in disguise.
+HOT_TABLES = ("users", "session", "posts", "wall_versions", "post_stats", "wall_posters")
+# functions allowed to scan, they are run by maintenance commands and not by requests
+FULL_SCAN_ALLOWED = (
+    "iterUsers", "iterPosts", "migrate_schema", "rebuild_search_index", "strip_sender_prefixes", "reshard_posts", "recompute_stats",
+)
+UNTIMED_PREFIXES = ("BEGIN", "ATTACH", "COMMIT", "ROLLBACK")
+TIMING_REPEATS = 20
+GROWTH_LIMIT = 0.5 # share of the size ratio a hot path statement may slow down by
+POSTS_PER_USER = 10
+WORDS = ("hello", "coffee", "snow", "summer", "lecture", "exam", "party", "weekend", "music", "train", "today", "thanks")
+SCAN = re.compile(r"^SCAN (?:\w+\.)?(\w+)")
+
+class Statement:
+    def __init__(self, function, line, sql):
+        self.function = function
+        self.line = line
+        self.sql = sql
+        self.plan = []
+        self.scans = [] # hot tables read in full
+        self.timings = [] # seconds per run on each database
+        self.growth_limit = None
+
+    @property
+    def growth(self):
+        #how much slower the statement got on the bigger database
+        if None in self.timings or not self.timings or not self.timings[0]:
+            return None
+        return self.timings[-1] / self.timings[0]
+
+    @property
+    def grows(self):
+        return self.growth is not None and self.growth_limit is not None and self.growth >= self.growth_limit
+
+    @property
+    def failed(self):
+        return self.function not in FULL_SCAN_ALLOWED and (bool(self.scans) or self.grows)
+
+def extract_statements(path=None):
+    # the SQL of every execute/executemany call in database_helper, evaluated in the module's
+    # namespace so constants like MESSAGE_SELECT are filled in. Returns (statements, dynamic)
+    # where dynamic lists the (function, line) of calls whose SQL is only known at run time
+    path = path or database_helper.__file__
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), path)
+    namespace = vars(database_helper)
+    statements = []
+    dynamic = []
+    for function in ast.walk(tree):
+        if not isinstance(function, ast.FunctionDef):
+            continue
+        for node in ast.walk(function):
+            if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                    and node.func.attr in ("execute", "executemany") and node.args):
+                continue
+            try:
+                sql = eval(compile(ast.Expression(node.args[0]), path, "eval"), namespace)
+            except Exception:
+                sql = None
+            if isinstance(sql, str):
+                statements.append(Statement(function.name, node.lineno, sql))
+            else:
+                dynamic.append((function.name, node.lineno))
+    statements.sort(key=lambda statement: statement.line)
+    return statements, dynamic
+
+def sample_parameters(sql):
+    # plausible values for the placeholders, guessed from the SQL just before each of them
+    values = []
+    for match in re.finditer(r"\?", sql):
+        before = sql[:match.start()].upper().rstrip()
+        if before.endswith("LIMIT"):
+            values.append(10)
+        elif before.endswith("OFFSET"):
+            values.append(0)
+        elif before.endswith("MATCH"):
+            values.append(f'wall : "{"user1@twidder.test".encode("utf-8").hex().upper()}" AND "hello"')
+        elif re.search(r"(POST_ID|EXPIRES_AT|VERSION)\s*[<>=]+$", before):
+            values.append(1)
+        else:
+            values.append("user1@twidder.test")
+    return values
+
+def populate(path, posts):
+    # builds a database from schema.sql with posts posts spread over posts / POSTS_PER_USER users
+    db = database_helper.connect(path)
+    with open(database_helper.SCHEMA) as f:
+        db.executescript(f.read())
+    users = max(1, posts // POSTS_PER_USER)
+    emails = [f"user{i}@twidder.test" for i in range(users)]
+    for start in range(0, users, 5000):
+        database_helper.add_users(db, [
+            (email, "x", "First", "Last", "other", "City", "Country") for email in emails[start:start + 5000]
+        ])
+    db.executemany(
+        "INSERT INTO session (email, token, expires_at) VALUES (?, ?, ?)",
+        [(email, f"token{i}", int(time.time()) + 3600) for i, email in enumerate(emails)]
+    )
+    db.commit()
+    for start in range(0, posts, 5000):
+        database_helper.insert_posts(db, [
+            (emails[i * 7 % users], emails[i % users], f"{WORDS[i * 13 % len(WORDS)]} post {i}")
+            for i in range(start, min(start + 5000, posts))
+        ])
+    return db
+
+def explain(db, statement):
+    parameters = sample_parameters(statement.sql)
+    try:
+        statement.plan = [row[3] for row in db.execute("EXPLAIN QUERY PLAN " + statement.sql, parameters)]
+    except sqlite3.Error as e:
+        #migration DDL that the up to date test schema has already applied
+        statement.plan = [f"not planned: {e}"]
+    for detail in statement.plan:
+        match = SCAN.match(detail)
+        if match and match.group(1) in HOT_TABLES:
+            statement.scans.append(match.group(1))
+
+def time_statement(db, statement):
+    # median seconds per run, None for statements that can't run inside a transaction
+    if statement.sql.lstrip().upper().startswith(UNTIMED_PREFIXES):
+        return None
+    parameters = sample_parameters(statement.sql)
+    runs = []
+    for _ in range(TIMING_REPEATS):
+        db.execute("BEGIN")
+        try:
+            start = time.perf_counter()
+            db.execute(statement.sql, parameters).fetchall()
+            runs.append(time.perf_counter() - start)
+        except sqlite3.Error:
+            return None
+        finally:
+            db.rollback()
+    return statistics.median(runs)
+
+def check(rows=10000, scale=10):
+    # returns (statements, dynamic) with plans and timings filled in
+    statements, dynamic = extract_statements()
+    directory = tempfile.mkdtemp()
+    try:
+        databases = [populate(os.path.join(directory, f"plans-{size}.db"), size) for size in (rows, rows * scale)]
+        for statement in statements:
+            explain(databases[-1], statement)
+            statement.timings = [time_statement(db, statement) for db in databases]
+            statement.growth_limit = max(2, scale * GROWTH_LIMIT)
+        for db in databases:
+            db.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return statements, dynamic
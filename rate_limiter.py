@@ -0,0 +1,130 @@
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from flask import jsonify, request
+
+import metrics
+
+# Token bucket rate limiting, checked in before_request so a rejected request never
+# reaches the route's database or bcrypt work. Every request takes a token from the bucket
+# of its client IP, per route. Signed requests also take one from the bucket of their email,
+# but only once the signature checks out, so nobody can empty the bucket of someone else's
+# account by sending their email. Buckets live in memory (least recently used ones are
+# dropped beyond RATE_LIMIT_MAX_BUCKETS) or, with TWIDDER_RATE_LIMIT_STORE=sqlite, in a
+# SQLite file shared by all worker processes.
+RATE_LIMIT_ENABLED = os.environ.get("TWIDDER_RATE_LIMIT", "1") == "1"
+RATE_LIMIT_STORE = os.environ.get("TWIDDER_RATE_LIMIT_STORE", "memory") # "memory" or "sqlite"
+RATE_LIMIT_DATABASE = os.environ.get("TWIDDER_RATE_LIMIT_DATABASE", "bus.db")
+RATE_LIMIT_MAX_BUCKETS = int(os.environ.get("TWIDDER_RATE_LIMIT_MAX_BUCKETS", 100000))
+RATE_LIMIT_IDLE = 3600 # seconds after which the sqlite store forgets a bucket
+
+# endpoint -> (burst capacity, tokens refilled per second)
+RATE_LIMITS = {
+    "sign_in": (10, 0.2), # bcrypt bound
+    "sign_up": (5, 0.05),
+    "change_password": (5, 0.05),
+    "post_message": (30, 2), # one commit per post
+    "batch": (30, 5),
+    "search_messages": (30, 5),
+}
+DEFAULT_RATE_LIMIT = (120, 30)
+EXEMPT_ENDPOINTS = ("static", "serve_client", "serve_asset", "get_metrics")
+
+class MemoryStore:
+    def __init__(self, max_buckets=RATE_LIMIT_MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        self.buckets = OrderedDict() # key -> [tokens, updated]
+        self.lock = threading.Lock()
+
+    def take(self, key, capacity, rate):
+        #returns 0 when a token was taken, else the seconds until the next one
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [capacity, now]
+                while len(self.buckets) > self.max_buckets:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+                bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            return (1 - bucket[0]) / rate
+
+class SqliteStore:
+    def __init__(self, database=RATE_LIMIT_DATABASE):
+        self.db = sqlite3.connect(database, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA busy_timeout=5000")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS rate_buckets ("
+            "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, allowed INTEGER NOT NULL)"
+        )
+        self.lock = threading.Lock()
+        self.last_prune = time.time()
+
+    def take(self, key, capacity, rate):
+        now = time.time()
+        with self.lock:
+            #refill and take in one statement so concurrent workers can't both take the last token
+            tokens, allowed = self.db.execute(
+                "INSERT INTO rate_buckets (key, tokens, updated, allowed) VALUES (:key, :capacity - 1, :now, 1) "
+                "ON CONFLICT(key) DO UPDATE SET "
+                "allowed=(min(:capacity, tokens + (:now - updated) * :rate) >= 1), "
+                "tokens=min(:capacity, tokens + (:now - updated) * :rate) - (min(:capacity, tokens + (:now - updated) * :rate) >= 1), "
+                "updated=:now "
+                "RETURNING tokens, allowed",
+                {"key": key, "capacity": capacity, "rate": rate, "now": now}
+            ).fetchone()
+            if now - self.last_prune > RATE_LIMIT_IDLE:
+                self.db.execute("DELETE FROM rate_buckets WHERE updated<?", (now - RATE_LIMIT_IDLE,))
+                self.last_prune = now
+        if allowed:
+            return 0
+        return (1 - tokens) / rate
+
+def create_store():
+    if RATE_LIMIT_STORE == "sqlite":
+        return SqliteStore()
+    return MemoryStore()
+
+store = create_store()
+signed_email = None # function returning the email of a correctly signed request, else None
+
+def email_source(function):
+    #registers the function that verifies a request's signature and returns its email
+    global signed_email
+    signed_email = function
+    return function
+
+def take(key, capacity, rate):
+    #a 429 response when the bucket of key is empty, else None
+    wait = store.take(key, capacity, rate)
+    if not wait:
+        return None
+    metrics.rate_limited.inc(1, request.endpoint)
+    response = jsonify({"message": "Too many requests"})
+    response.headers["Retry-After"] = str(max(1, math.ceil(wait)))
+    return response, 429
+
+def before_request():
+    if not RATE_LIMIT_ENABLED or request.endpoint is None or request.endpoint in EXEMPT_ENDPOINTS:
+        return None
+    capacity, rate = RATE_LIMITS.get(request.endpoint, DEFAULT_RATE_LIMIT)
+    limited = take(f"{request.endpoint}:ip:{request.remote_addr}", capacity, rate)
+    if limited or signed_email is None:
+        return limited
+    email = signed_email()
+    if email:
+        return take(f"{request.endpoint}:email:{email}", capacity, rate)
+    return None
+
+def init_app(app):
+    app.before_request(before_request)
@@ -11,12 +11,73 @@ CREATE TABLE IF NOT EXISTS users (
 
 CREATE TABLE IF NOT EXISTS session (
     email VARCHAR(64) PRIMARY KEY,
-    token VARCHAR(64) NOT NULL
+    token VARCHAR(64) NOT NULL,
+    expires_at INTEGER NOT NULL
 );
 
+CREATE UNIQUE INDEX IF NOT EXISTS session_token ON session (token);
+CREATE INDEX IF NOT EXISTS session_expires_at ON session (expires_at);
+
 CREATE TABLE IF NOT EXISTS posts (
     SENT_BY VARCHAR(64) NOT NULL,
     SENT_TO VARCHAR(64) NOT NULL,
     POST TEXT NOT NULL,
     POST_ID INTEGER PRIMARY KEY AUTOINCREMENT
 );
+
+CREATE INDEX IF NOT EXISTS posts_sent_to_post_id ON posts (SENT_TO, POST_ID);
+
+CREATE TABLE IF NOT EXISTS wall_versions (
+    email VARCHAR(64) PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+
+-- full text index of the posts, contentless so it can also hold the wall (hex of SENT_TO
+-- as a single token) which lets a search only visit the posts of one wall
+CREATE VIRTUAL TABLE IF NOT EXISTS posts_search USING fts5(POST, wall, content='');
+
+CREATE TRIGGER IF NOT EXISTS posts_search_insert AFTER INSERT ON posts BEGIN
+    INSERT INTO posts_search (rowid, POST, wall) VALUES (new.POST_ID, new.POST, hex(new.SENT_TO));
+END;
+
+CREATE TRIGGER IF NOT EXISTS posts_search_delete AFTER DELETE ON posts BEGIN
+    INSERT INTO posts_search (posts_search, rowid, POST, wall) VALUES ('delete', old.POST_ID, old.POST, hex(old.SENT_TO));
+END;
+
+CREATE TRIGGER IF NOT EXISTS posts_search_update AFTER UPDATE OF POST, SENT_TO ON posts BEGIN
+    INSERT INTO posts_search (posts_search, rowid, POST, wall) VALUES ('delete', old.POST_ID, old.POST, hex(old.SENT_TO));
+    INSERT INTO posts_search (rowid, POST, wall) VALUES (new.POST_ID, new.POST, hex(new.SENT_TO));
+END;
+
+-- per user counters and posts per (wall, poster), kept up to date by the triggers below in
+-- the transaction of the insert, so profile stats are read without counting posts
+CREATE TABLE IF NOT EXISTS post_stats (
+    email VARCHAR(64) PRIMARY KEY,
+    received INTEGER NOT NULL,
+    sent INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS wall_posters (
+    wall VARCHAR(64) NOT NULL,
+    poster VARCHAR(64) NOT NULL,
+    posts INTEGER NOT NULL,
+    PRIMARY KEY (wall, poster)
+);
+
+CREATE INDEX IF NOT EXISTS wall_posters_top ON wall_posters (wall, posts);
+
+CREATE TRIGGER IF NOT EXISTS post_stats_insert AFTER INSERT ON posts BEGIN
+    INSERT INTO post_stats (email, received, sent) VALUES (new.SENT_TO, 1, 0)
+        ON CONFLICT(email) DO UPDATE SET received=received+1;
+    INSERT INTO post_stats (email, received, sent) VALUES (new.SENT_BY, 0, 1)
+        ON CONFLICT(email) DO UPDATE SET sent=sent+1;
+    INSERT INTO wall_posters (wall, poster, posts) VALUES (new.SENT_TO, new.SENT_BY, 1)
+        ON CONFLICT(wall, poster) DO UPDATE SET posts=posts+1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS post_stats_delete AFTER DELETE ON posts BEGIN
+    UPDATE post_stats SET received=received-1 WHERE email=old.SENT_TO;
+    UPDATE post_stats SET sent=sent-1 WHERE email=old.SENT_BY;
+    UPDATE wall_posters SET posts=posts-1 WHERE wall=old.SENT_TO AND poster=old.SENT_BY;
+    DELETE FROM wall_posters WHERE wall=old.SENT_TO AND poster=old.SENT_BY AND posts<=0;
+END;
@@ -1,26 +1,88 @@
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, abort, jsonify, request, send_from_directory, stream_with_context
 from flask_sock import Sock
-from flask_bcrypt import Bcrypt
+import click
 import hashlib
 import database_helper
+import password_hasher
+import post_writer
+import metrics
+import compression
+import rate_limiter
+import assets
+import bulk_data
+import query_plans
+import mimetypes
+import session_registry
 import re
 import random
 import hmac
+import json
+import os
+import sys
 import time
+import threading
 
 
 app = Flask(__name__, static_folder='static')
 sock = Sock(app) #initialize the websocket
-bcrypt = Bcrypt(app) #initialize the bcrypt
-active_sessions = {} #dictionary to store active sessions
+active_sessions = session_registry.create_registry() #open websockets of the logged in users, shared between workers
+app.teardown_appcontext(database_helper.close_db) #return the db connection to the pool after each request
+metrics.init_app(app, database_helper, password_hasher) #time routes, sql statements and bcrypt
+rate_limiter.init_app(app) #per user and per ip token buckets, checked before any db or bcrypt work
+metrics.add_gauge("twidder_active_websockets", "Open websockets held by this worker", lambda: len(active_sessions))
+metrics.add_gauge("twidder_open_websockets", "Websockets of this worker including the ones not signed in yet", lambda: open_websockets)
+for cache_name in ("session", "user"):
+    for field in ("hits", "misses", "size"):
+        metrics.add_gauge(
+            f"twidder_{cache_name}_cache_{field}", f"{field} of the {cache_name} cache",
+            lambda cache_name=cache_name, field=field: database_helper.cache_stats()[cache_name][field]
+        )
+
+asset_manifest = assets.load_manifest() #fingerprinted static files, None until build-assets ran
+
+def send_built_file(name, cache_control):
+    #serves a file of static/dist, precompressed when the client accepts it
+    entry = asset_manifest["files"].get(name)
+    if entry is None:
+        abort(404)
+    encoding = request.accept_encodings.best_match(entry["encodings"])
+    path = name + ("." + ("gz" if encoding == "gzip" else encoding) if encoding else "")
+    response = send_from_directory(
+        assets.DIST_DIR, path, mimetype=mimetypes.guess_type(name)[0],
+        etag=f"{entry['etag']}-{encoding or 'identity'}", conditional=True
+    )
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.headers["Cache-Control"] = cache_control
+    response.vary.add("Accept-Encoding")
+    return response
 
 @app.route('/')
 def serve_client():
-    return send_from_directory('static', 'client.html')
+    if asset_manifest is None:
+        return send_from_directory('static', 'client.html')
+    #the page itself is revalidated, everything it links to is immutable
+    return send_built_file(assets.PAGE, "no-cache")
+
+@app.route('/assets/<path:filename>')
+def serve_asset(filename):
+    if asset_manifest is None or filename == assets.PAGE:
+        abort(404)
+    return send_built_file(filename, assets.IMMUTABLE)
 
 # Helper functions and constants
 MIN_PASSWORD_LENGTH = 8 
 MAX_REQUEST_TIME = 300  # 5 minutes
+SESSION_REAP_INTERVAL = 60  # seconds between two sweeps of expired sessions
+WS_PING_INTERVAL = int(os.environ.get("TWIDDER_WS_PING_INTERVAL", 25))  # seconds between heartbeats, 0 disables them
+WS_AUTH_TIMEOUT = 10  # seconds a new websocket has to send its token
+WS_MAX_CONNECTIONS = int(os.environ.get("TWIDDER_WS_MAX_CONNECTIONS", 1000))  # open websockets per worker
+WS_TRY_AGAIN_LATER = 1013  # close code for sockets turned away at capacity
+WS_NO_STATUS = 1005  # close reason of a socket the client never sent a close frame on
+WS_AUTH_FAILED = 1008  # close code for sockets whose token is unknown or expired, the client must not retry
+
+# the server pings every socket, one that has not answered by the next ping is closed
+app.config["SOCK_SERVER_OPTIONS"] = {"ping_interval": WS_PING_INTERVAL or None}
 
 class User:
     def __init__(self, email, password, firstname, lastname, gender, city, country):
@@ -40,6 +102,64 @@ def check_email(email):
     data = database_helper.check_email(email)
     return data is None 
 
+def get_page_args():
+    #read the keyset pagination parameters (before_id, limit) from the query string
+    before_id = request.args.get("before_id", type=int)
+    limit = request.args.get("limit", database_helper.MESSAGE_PAGE_SIZE, type=int)
+    return before_id, max(1, min(limit, database_helper.MAX_MESSAGE_PAGE_SIZE))
+
+def messages_page(messages, limit):
+    #the cursor for the next page is the oldest post id of this page, None when the wall is exhausted
+    next_before_id = messages[-1]["post_id"] if messages and len(messages) >= limit else None
+    return {"message": "User messages retrieved", "data": messages, "next_before_id": next_before_id}
+
+def stream_messages_page(messages, limit):
+    #same document as messages_page, encoded one post at a time while the cursor is read
+    yield '{"message": "User messages retrieved", "data": ['
+    count = 0
+    last_id = None
+    for message in messages:
+        yield ("," if count else "") + json.dumps(message)
+        count += 1
+        last_id = message["post_id"]
+    next_before_id = last_id if count >= limit else None
+    yield '], "next_before_id": ' + json.dumps(next_before_id) + '}'
+
+def guard_stream(body):
+    #the status is already sent when a streamed body fails, so log the error and let it
+    #propagate: the server then drops the connection and the client sees a broken response
+    #instead of a well-formed page that silently misses posts
+    try:
+        yield from body
+    except Exception as e:
+        print(f"Error streaming {request.path}: {e}")
+        metrics.stream_failed()
+        raise
+
+def messages_response(email):
+    #answer a wall read, or 304 when the client already has this version of the page.
+    #the etag also identifies the wall because both the page and the reader share the URL.
+    #it is weak because the same page is sent with different content encodings
+    before_id, limit = get_page_args()
+    version = database_helper.getWallVersion(email)
+    wall = hashlib.sha256(email.encode('utf-8')).hexdigest()[:16]
+    etag = f"{wall}-{version}-{before_id or 0}-{limit}"
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        body = stream_messages_page(database_helper.iterMessagesByEmail(email, before_id, limit), limit)
+        encoding = compression.negotiate(request.accept_encodings)
+        if encoding is not None:
+            body = compression.compress_stream(body, encoding)
+        response = app.response_class(stream_with_context(guard_stream(body)), mimetype="application/json")
+        if encoding is not None:
+            response.headers["Content-Encoding"] = encoding
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.vary.add("email")
+    response.vary.add("Accept-Encoding")
+    return response
+
 def generate_token(length=36):
     letters = 'abcdefghiklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ1234567890'
     return ''.join(random.choices(letters, k=length))
@@ -66,25 +186,143 @@ def verify_request_signature(email, request_data, signature, timestamp):
     #compare the expected signature with the signature in the request
     return hmac.compare_digest(signature, expected_signature)
 
+@rate_limiter.email_source
+def signed_request_email():
+    #the email of a request whose signature checks out, charged to the per account rate limit
+    email = request.headers.get("email")
+    timestamp = request.headers.get("Timestamp")
+    signature = request.headers.get("Signature")
+    if not email or not timestamp or not signature:
+        return None
+    try:
+        raw_data = request.data.decode('utf-8') if request.data else ""
+        if verify_request_signature(email, raw_data, signature, int(timestamp)):
+            return email
+    except ValueError:
+        pass
+    return None
+
+def hasher_busy():
+    response = jsonify({"message": "Server busy, please try again"})
+    response.headers["Retry-After"] = str(password_hasher.HASH_RETRY_AFTER)
+    return response, 503
+
+@app.errorhandler(password_hasher.HasherBusy)
+def handle_hasher_busy(e):
+    return hasher_busy()
+
+#----------------------------------------session reaper----------------------------------------
+def reap_sessions():
+    while True:
+        time.sleep(SESSION_REAP_INTERVAL)
+        try:
+            with app.app_context():
+                expired = database_helper.delete_expired_sessions()
+            #tell the clients whose session expired that they have to log in again
+            for email in expired:
+                active_sessions.logout(email)
+        except Exception as e:
+            print(f"Error reaping expired sessions: {e}")
+
+session_reaper_started = False
+session_reaper_lock = threading.Lock()
+
+def start_session_reaper():
+    #one reaper per process, whichever server (flask run, gunicorn, uvicorn) runs the app
+    global session_reaper_started
+    with session_reaper_lock:
+        if session_reaper_started:
+            return
+        session_reaper_started = True
+    threading.Thread(target=reap_sessions, daemon=True).start()
+
+@app.before_request
+def start_session_reaper_lazily():
+    #started on the first request rather than at import, so a forking server starts it in each worker
+    if not session_reaper_started:
+        start_session_reaper()
+
 #----------------------------------------websocket----------------------------------------
+# Frames sent to the client: the plain text "logout", {"type": "post", ...} for every new post
+# on the user's wall and {"type": "posts", "data": [...], "complete": bool} answering a
+# {"type": "since", "post_id": N} resync request sent by the client after reconnecting.
+def push_post(recipient, post):
+    #only the push needs the sender's name, so it is looked up only when a socket can receive it
+    if not active_sessions.may_reach(recipient):
+        return
+    sender = database_helper.getUserDataByEmail(post["sent_by"]) or {}
+    post["sender"] = {"firstname": sender.get("firstname"), "lastname": sender.get("lastname")}
+    active_sessions.send(recipient, json.dumps({"type": "post", **post}))
+
+def handle_ws_message(email, message):
+    #returns the frame to answer with, None for messages that need no answer
+    try:
+        request_data = json.loads(message)
+    except ValueError:
+        return None
+    if not isinstance(request_data, dict) or request_data.get("type") != "since":
+        return None
+    try:
+        after_id = int(request_data.get("post_id", 0))
+    except (TypeError, ValueError):
+        return None
+    limit = database_helper.MAX_MESSAGE_PAGE_SIZE
+    messages = database_helper.getMessagesSince(email, after_id, limit)
+    #when the client missed more than one page it has to reload the wall over http
+    return json.dumps({"type": "posts", "data": messages, "complete": len(messages) < limit})
+
+open_websockets = 0
+open_websockets_lock = threading.Lock()
+
+def acquire_websocket_slot():
+    #every open socket holds a thread, beyond WS_MAX_CONNECTIONS new ones are turned away
+    global open_websockets
+    with open_websockets_lock:
+        if open_websockets >= WS_MAX_CONNECTIONS:
+            metrics.websockets_rejected.inc()
+            return False
+        open_websockets += 1
+        return True
+
+def release_websocket_slot():
+    global open_websockets
+    with open_websockets_lock:
+        open_websockets -= 1
+
+def missed_heartbeat(ws):
+    #simple_websocket closes a socket whose pong did not arrive before the next ping
+    return ws.close_reason == WS_NO_STATUS and not ws.pong_received
+
 @sock.route("/ws")
 def ws(ws):
-    token = ws.receive() 
+    if not acquire_websocket_slot():
+        ws.close(WS_TRY_AGAIN_LATER, "Server busy, try again later")
+        return
+    try:
+        websocket_session(ws)
+    finally:
+        release_websocket_slot()
+        if missed_heartbeat(ws):
+            metrics.websockets_evicted.inc(1, "heartbeat")
+
+def websocket_session(ws):
+    token = ws.receive(timeout=WS_AUTH_TIMEOUT)
+    if token is None:
+        metrics.websockets_evicted.inc(1, "auth_timeout")
+        ws.close()
+        return
     email = database_helper.getEmailByToken(token)
+    #don't keep a pooled db connection for the whole life of the socket
+    database_helper.close_db()
     
     if not email:
-        ws.close()
+        #tell the client to drop its token, or it would reconnect with it forever
+        ws.send("logout")
+        ws.close(WS_AUTH_FAILED, "Session expired")
         return
     
-    # Close any existing WebSocket connection for this user
-    if email in active_sessions:
-        try:
-            active_sessions[email].send("logout")
-            active_sessions[email].close()
-        except Exception as e:
-            print(f"Error closing old WebSocket for {email}: {e}")
-    # Store the new WebSocket connection
-    active_sessions[email] = ws
+    # Store the new WebSocket connection, any existing one for this user (in any worker) gets logged out
+    active_sessions.register(email, ws)
 
     # Listen for incoming messages
     try:
@@ -92,12 +330,15 @@ def ws(ws):
             message = ws.receive()
             if not message:
                 break 
+            reply = handle_ws_message(email, message)
+            database_helper.close_db()
+            if reply is not None:
+                ws.send(reply)
     except:
         pass
     finally:
         # Remove the WebSocket connection when the connection is closed
-        if active_sessions.get(email) == ws:
-            del active_sessions[email]
+        active_sessions.unregister(email, ws)
         ws.close()
 
 #----------------------------------------sign_up----------------------------------------
@@ -127,7 +368,7 @@ def sign_up():
         return jsonify({"message": "Email already registered"}),409
     
     #hash the password before storing it in the database
-    hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
+    hashed_password = password_hasher.generate_password_hash(password)
     new_user = User(email, hashed_password, firstname, lastname, gender, city, country)
 
     try:
@@ -157,7 +398,7 @@ def sign_in():
     
     #check if the password is correct by comparing the hashed password in the database with the password entered by the user
     stored_password = database_helper.getPasswordByEmail(email)
-    if not bcrypt.check_password_hash(stored_password, password):
+    if not password_hasher.check_password_hash(stored_password, password):
         return jsonify({"message": "Wrong password"}), 401
     
     token = generate_token()
@@ -191,8 +432,7 @@ def sign_out():
         
         #delete the session from the database and the active sessions dictionary
         database_helper.delete_session(token)
-        if email in active_sessions:
-            del active_sessions[email]
+        active_sessions.discard(email)
         return jsonify({"message": "User signed out"}), 200
     
     except Exception as e:
@@ -229,16 +469,18 @@ def change_password():
     
         #check if the old password is correct by comparing the hashed password in the database with the password entered by the user
         stored_password = database_helper.getPasswordByEmail(email)
-        if not bcrypt.check_password_hash(stored_password, old_password):
+        if not password_hasher.check_password_hash(stored_password, old_password):
             return jsonify({"message": "Wrong password"}), 401
         
         #hash the new password before storing it in the database
-        hashed_password = bcrypt.generate_password_hash(new_password).decode('utf-8')
+        hashed_password = password_hasher.generate_password_hash(new_password)
         if database_helper.change_password(email, hashed_password):
             return jsonify({"message": "Password changed"}), 200
         else:
             return jsonify({"message": "Failed to change password"}), 500
-        
+
+    except password_hasher.HasherBusy:
+        return hasher_busy()
     except Exception as e:
         return jsonify({"message": "An error occurred during password change", "error": str(e)}), 500
 
@@ -325,9 +567,7 @@ def get_user_messages_by_token():
         if not verify_request_signature(email, raw_data, signature, int(timestamp)):
             return jsonify({"message": "Invalid signature"}), 401
 
-        messages = database_helper.getMessagesByEmail(email)
-
-        return jsonify({"message": "User messages retrieved", "data": messages}), 200
+        return messages_response(email)
     
     except Exception as e:
         return jsonify({"message": "An error occurred during message retrieval", "error":str(e)}),500
@@ -354,10 +594,8 @@ def get_user_messages_by_email(email):
         if check_email(email):
             return jsonify({"message": "Email not registered"}), 404
         
-        #get the messages from the database by email
-        messages = database_helper.getMessagesByEmail(email)
-
-        return jsonify({"message": "User messages retrieved", "data": messages}), 200
+        #get a page of messages from the database by email
+        return messages_response(email)
     
     except Exception as e:
         return jsonify({"message": "An error occurred during message retrieval", "error": str(e)}), 500
@@ -377,11 +615,15 @@ def post_message():
     if request.method != "POST":
         return jsonify({"message": "Invalid request method"}), 405
     
-    if not message:
+    if not message or not isinstance(message, str):
         return jsonify({"message": "Missing message"}), 400
+
+    #posts of several requests share a transaction, a bad row must not reach it
+    if not recipient or not isinstance(recipient, str):
+        return jsonify({"message": "Missing recipient"}), 400
     
     #check if the recipient is registered in the database
-    if recipient and check_email(recipient):
+    if check_email(recipient):
         return jsonify({"message": "Recipient not registered"}), 404
     
     try:
@@ -389,21 +631,273 @@ def post_message():
         if not verify_request_signature(UserEmail, raw_data, signature, int(timestamp)):
             return jsonify({"message": "Invalid signature"}), 401
         
-        #modify the message to include the name of the sender and the recipient
-        if UserEmail == recipient:
-            modified_message = "Me: " + message
-        else:
-            userdata = database_helper.getUserDataByEmail(UserEmail)
-            recipient_name = userdata["firstname"] + " " + userdata["lastname"]
-            modified_message = recipient_name + ": " + message
-        
-        #add the message to the database
-        database_helper.add_message(UserEmail, recipient, modified_message)
+        #add the message to the database, the sender's name is joined in when the wall is read
+        post_id = post_writer.add_message(UserEmail, recipient, message)
+        push_post(recipient, {"post_id": post_id, "sent_by": UserEmail, "sent_to": recipient, "post": message})
 
         return jsonify({"message": "Message posted"}), 200
     except Exception as e:
         return jsonify({"message": "An error occurred during message posting", "error": str(e)}), 500
 
 
+#----------------------------------------batch----------------------------------------
+# Runs several read operations with one signed request, e.g. on page load:
+# {"operations": [{"op": "get_user_data_by_token"}, {"op": "get_user_messages_by_token", "limit": 50}]}
+# Every operation gets its own {"status": ..., "body": ...} in the same order as requested.
+MAX_BATCH_OPERATIONS = 10
+
+def batch_user_data(email):
+    if not email:
+        return {"message": "Missing email"}, 400
+    user_data = database_helper.getUserDataByEmail(email)
+    if user_data is None:
+        return {"message": "No user data found"}, 404
+    return {"message": "User data retrieved", "data": user_data}, 200
+
+def batch_user_messages(email, operation):
+    if not email:
+        return {"message": "Missing email"}, 400
+    if check_email(email):
+        return {"message": "Email not registered"}, 404
+    try:
+        before_id = operation.get("before_id")
+        before_id = int(before_id) if before_id is not None else None
+        limit = int(operation.get("limit", database_helper.MESSAGE_PAGE_SIZE))
+    except (TypeError, ValueError):
+        return {"message": "Invalid pagination parameters"}, 400
+    limit = max(1, min(limit, database_helper.MAX_MESSAGE_PAGE_SIZE))
+    messages = database_helper.getMessagesByEmail(email, before_id, limit)
+    return messages_page(messages, limit), 200
+
+def batch_user_stats(email):
+    if not email:
+        return {"message": "Missing email"}, 400
+    if check_email(email):
+        return {"message": "Email not registered"}, 404
+    return {"message": "User stats retrieved", "data": database_helper.getUserStats(email)}, 200
+
+BATCH_OPERATIONS = {
+    "get_user_data_by_token": lambda email, operation: batch_user_data(email),
+    "get_user_data_by_email": lambda email, operation: batch_user_data(operation.get("email")),
+    "get_user_messages_by_token": lambda email, operation: batch_user_messages(email, operation),
+    "get_user_messages_by_email": lambda email, operation: batch_user_messages(operation.get("email"), operation),
+    "get_user_stats": lambda email, operation: batch_user_stats(operation.get("email", email)),
+}
+
+@app.route("/batch", methods=["POST"])
+def batch():
+    data = request.get_json(silent=True) or {}
+    raw_data = request.data.decode('utf-8') if request.data else ""
+    email = request.headers.get("email")
+    signature = request.headers.get("Signature")
+    timestamp = request.headers.get("Timestamp")
+    operations = data.get("operations")
+
+    if not all([email, signature, timestamp]):
+        return jsonify({"message": "Missing required fields"}), 400
+
+    if not isinstance(operations, list) or not operations or len(operations) > MAX_BATCH_OPERATIONS:
+        return jsonify({"message": f"Expected between 1 and {MAX_BATCH_OPERATIONS} operations"}), 400
+
+    try:
+        #one signature check and token lookup for the whole batch
+        if not verify_request_signature(email, raw_data, signature, int(timestamp)):
+            return jsonify({"message": "Invalid signature"}), 401
+
+        #all operations share the connection of this request (g.db)
+        results = []
+        for operation in operations:
+            handler = BATCH_OPERATIONS.get(operation.get("op")) if isinstance(operation, dict) else None
+            if handler is None:
+                body, status = {"message": "Unknown operation"}, 400
+            else:
+                body, status = handler(email, operation)
+            results.append({"status": status, "body": body})
+
+        return jsonify({"message": "Batch processed", "data": results}), 200
+
+    except Exception as e:
+        return jsonify({"message": "An error occurred during batch processing", "error": str(e)}), 500
+
+
+#----------------------------------------search_messages----------------------------------------
+@app.route("/search_messages/<email>", methods=["GET"])
+def search_messages(email):
+    raw_data = request.data.decode('utf-8') if request.data else ""
+    UserEmail = request.headers.get("email")
+    signature = request.headers.get("Signature")
+    timestamp = request.headers.get("Timestamp")
+    text = request.args.get("q", "")
+    limit = request.args.get("limit", database_helper.SEARCH_PAGE_SIZE, type=int)
+    offset = request.args.get("offset", 0, type=int)
+
+    if not all([UserEmail, signature, timestamp]):
+        return jsonify({"message": "Missing required fields"}), 400
+
+    try:
+        if not verify_request_signature(UserEmail, raw_data, signature, int(timestamp)):
+            return jsonify({"message": "Invalid signature"}), 401
+
+        if check_email(email):
+            return jsonify({"message": "Email not registered"}), 404
+
+        limit = max(1, min(limit, database_helper.MAX_MESSAGE_PAGE_SIZE))
+        messages = database_helper.searchMessages(email, text, limit, offset)
+        if messages is None:
+            return jsonify({"message": "Missing search text"}), 400
+
+        #ranked results have no stable cursor, the next page starts at the next offset
+        next_offset = offset + limit if len(messages) >= limit else None
+        return jsonify({"message": "Search results retrieved", "data": messages, "next_offset": next_offset}), 200
+
+    except Exception as e:
+        return jsonify({"message": "An error occurred during search", "error": str(e)}), 500
+
+
+#----------------------------------------get_user_stats----------------------------------------
+@app.route("/get_user_stats/<email>", methods=["GET"])
+def get_user_stats(email):
+    raw_data = request.data.decode('utf-8') if request.data else ""
+    UserEmail = request.headers.get("email")
+    signature = request.headers.get("Signature")
+    timestamp = request.headers.get("Timestamp")
+
+    if not all([UserEmail, signature, timestamp]):
+        return jsonify({"message": "Missing required fields"}), 400
+
+    try:
+        if not verify_request_signature(UserEmail, raw_data, signature, int(timestamp)):
+            return jsonify({"message": "Invalid signature"}), 401
+
+        if check_email(email):
+            return jsonify({"message": "Email not registered"}), 404
+
+        stats = database_helper.getUserStats(email)
+        return jsonify({"message": "User stats retrieved", "data": stats}), 200
+
+    except Exception as e:
+        return jsonify({"message": "An error occurred while retrieving user stats", "error": str(e)}), 500
+
+
+#----------------------------------------metrics----------------------------------------
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return app.response_class(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+#----------------------------------------cli commands----------------------------------------
+@app.cli.command("migrate-database")
+def migrate_database_command():
+    """Bring a database created by an older schema.sql up to date."""
+    changes = database_helper.migrate_schema(database_helper.get_db())
+    for change in changes:
+        print(change[0].upper() + change[1:])
+    print("Schema applied" if changes else "Already up to date")
+
+
+@app.cli.command("strip-post-prefixes")
+def strip_post_prefixes_command():
+    """Remove the sender names baked into posts written by older versions (run once)."""
+    try:
+        stripped = sum(database_helper.strip_sender_prefixes(db) for db in database_helper.posts_dbs())
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    print(f"Stripped the sender prefix from {stripped} posts")
+
+
+@app.cli.command("build-assets")
+def build_assets_command():
+    """Fingerprint and precompress the static files into static/dist."""
+    global asset_manifest
+    asset_manifest = assets.build()
+    for asset, name in asset_manifest["assets"].items():
+        print(f"{asset} -> {name}")
+
+
+@app.cli.command("rebuild-search-index")
+def rebuild_search_index_command():
+    """Index all existing posts for /search_messages."""
+    indexed = sum(database_helper.rebuild_search_index(db) for db in database_helper.posts_dbs())
+    print(f"Indexed {indexed} posts")
+
+
+@app.cli.command("generate-data")
+@click.option("--users", default=1000, show_default=True, help="Number of users to add.")
+@click.option("--posts", default=10000, show_default=True, help="Number of posts between them.")
+@click.option("--password", default="password", show_default=True, help="Password of every generated user.")
+@click.option("--prefix", default="user", show_default=True, help="Emails are <prefix><n>@twidder.test.")
+@click.option("--batch-size", default=bulk_data.BATCH_SIZE, show_default=True, help="Rows per transaction.")
+@click.option("--seed", type=int, help="Seed for a reproducible dataset.")
+def generate_data_command(users, posts, password, prefix, batch_size, seed):
+    """Fill the database with synthetic users and posts."""
+    added, posted = bulk_data.generate(database_helper.get_db(), users, posts, password, prefix, batch_size, seed)
+    print(f"Added {added} users and {posted} posts")
+
+
+@app.cli.command("export-data")
+@click.argument("output", type=click.File("w", encoding="utf-8"), default="-")
+def export_data_command(output):
+    """Stream users and posts as NDJSON to OUTPUT (default stdout)."""
+    counts = bulk_data.export(database_helper.get_db(), output)
+    print(f"Exported {counts['users']} users and {counts['posts']} posts", file=sys.stderr)
+
+
+@app.cli.command("import-data")
+@click.argument("input", type=click.File("r", encoding="utf-8"), default="-")
+@click.option("--batch-size", default=bulk_data.BATCH_SIZE, show_default=True, help="Rows per transaction.")
+@click.option("--renumber", is_flag=True, help="Give the posts new ids, needed for exports of a different shard count.")
+def import_data_command(input, batch_size, renumber):
+    """Load an NDJSON export from INPUT (default stdin)."""
+    counts = bulk_data.import_lines(database_helper.get_db(), input, batch_size, renumber)
+    print(f"Imported {counts['users']} users and {counts['posts']} posts")
+
+
+@app.cli.command("reshard-posts")
+@click.argument("shards", type=int)
+@click.option("--batch-size", default=database_helper.RESHARD_BATCH_SIZE, show_default=True, help="Posts per transaction.")
+def reshard_posts_command(shards, batch_size):
+    """Copy the posts into SHARDS shard files (0 moves them back into the main database)."""
+    try:
+        copied = database_helper.reshard_posts(shards, batch_size=batch_size)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    print(f"Copied {copied} posts, restart the server with TWIDDER_POST_SHARDS={shards}")
+
+
+@app.cli.command("recompute-stats")
+def recompute_stats_command():
+    """Rebuild the post counters behind /get_user_stats from the posts."""
+    walls = sum(database_helper.recompute_stats(db) for db in database_helper.posts_dbs())
+    print(f"Recomputed the stats of {walls} walls")
+
+
+@app.cli.command("check-query-plans")
+@click.option("--rows", default=10000, show_default=True, help="Posts in the smaller test database.")
+@click.option("--scale", default=10, show_default=True, help="How many times bigger the second database is.")
+@click.option("--output", type=click.File("w"), help="Also write the plans and timings as JSON to this file.")
+def check_query_plans_command(rows, scale, output):
+    """Fail when a database_helper query scans a whole hot table."""
+    statements, dynamic = query_plans.check(rows, scale)
+    for statement in statements:
+        status = "FAIL" if statement.failed else ("scan" if statement.scans or statement.grows else "ok")
+        timings = " ".join(f"{t * 1000:8.3f}" if t is not None else "       -" for t in statement.timings)
+        growth = f"x{statement.growth:.1f}" if statement.growth is not None else "-"
+        print(f"{status:4} {statement.function}:{statement.line:<5} {timings} ms {growth:>7}  {'; '.join(statement.plan)}")
+    for function, line in dynamic:
+        print(f"skip {function}:{line} (SQL built at run time)")
+    if output:
+        json.dump({
+            "rows": [rows, rows * scale],
+            "statements": [{
+                "function": statement.function, "line": statement.line, "sql": statement.sql,
+                "plan": statement.plan, "full_scans": statement.scans, "failed": statement.failed,
+                "seconds": statement.timings, "growth": statement.growth,
+            } for statement in statements],
+        }, output, indent=2)
+    failed = [f"{statement.function}:{statement.line}" for statement in statements if statement.failed]
+    if failed:
+        raise click.ClickException("Full table scan or cost growing with the table on a hot path in " + ", ".join(failed))
+
+
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,170 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import database_helper
+
+# Registry of the open websockets, one per logged in user. LocalRegistry only knows the
+# sockets of this process. SqliteBusRegistry additionally publishes every logout and push
+# on a small SQLite event bus shared by all worker processes on the machine, each worker
+# polls the bus and applies the events to the sockets it holds. It also carries session
+# invalidations, so a token that was replaced or signed out elsewhere stops being trusted
+# from the session cache of every worker.
+REGISTRY_BACKEND = os.environ.get("TWIDDER_SESSION_REGISTRY", "local") # "local" or "sqlite"
+BUS_DATABASE = os.environ.get("TWIDDER_BUS_DATABASE", "bus.db")
+BUS_POLL_INTERVAL = 0.05 # seconds between two reads of the bus
+BUS_RETENTION = 60 # seconds events are kept before they are pruned
+
+class LocalRegistry:
+    def __init__(self):
+        self.sockets = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.sockets)
+
+    def __contains__(self, email):
+        return email in self.sockets
+
+    def get(self, email):
+        return self.sockets.get(email)
+
+    def may_reach(self, email):
+        #whether a frame sent to email can reach a socket, lets callers skip building it
+        return email in self.sockets
+
+    def register(self, email, ws):
+        #a user has at most one socket, the previous one gets logged out
+        with self.lock:
+            old = self.sockets.get(email)
+            self.sockets[email] = ws
+        if old is not None:
+            self.close_socket(email, old, "logout")
+
+    def unregister(self, email, ws):
+        with self.lock:
+            if self.sockets.get(email) is ws:
+                del self.sockets[email]
+
+    def deliver(self, email, frame):
+        #returns True when the frame was handed to a socket of this process
+        ws = self.sockets.get(email)
+        if ws is None:
+            return False
+        try:
+            ws.send(frame)
+        except Exception as e:
+            print(f"Error sending to WebSocket of {email}: {e}")
+        return True
+
+    def drop(self, email, frame=None):
+        with self.lock:
+            ws = self.sockets.pop(email, None)
+        if ws is not None:
+            self.close_socket(email, ws, frame)
+
+    def close_socket(self, email, ws, frame=None):
+        try:
+            if frame is not None:
+                ws.send(frame)
+            ws.close()
+        except Exception as e:
+            print(f"Error closing WebSocket for {email}: {e}")
+
+    def send(self, email, frame):
+        self.deliver(email, frame)
+
+    def logout(self, email):
+        self.drop(email, "logout")
+
+    def discard(self, email):
+        self.drop(email)
+
+
+class SqliteBusRegistry(LocalRegistry):
+    def __init__(self, database=BUS_DATABASE):
+        super().__init__()
+        self.origin = f"{os.getpid()}-{uuid.uuid4().hex}"
+        self.db = sqlite3.connect(database, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA busy_timeout=5000")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS events ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, created_at REAL NOT NULL, origin TEXT NOT NULL, "
+            "kind TEXT NOT NULL, email TEXT NOT NULL, frame TEXT)"
+        )
+        self.db_lock = threading.Lock()
+        self.last_id = self.db.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+        database_helper.session_listeners.append(self.publish_invalidation)
+        threading.Thread(target=self.poll, daemon=True).start()
+
+    def publish(self, kind, email, frame=None):
+        with self.db_lock:
+            self.db.execute(
+                "INSERT INTO events (created_at, origin, kind, email, frame) VALUES (?, ?, ?, ?, ?)",
+                (time.time(), self.origin, kind, email, frame)
+            )
+
+    def publish_invalidation(self, email, token):
+        #the frame column carries the token
+        self.publish("invalidate", email or "", token)
+
+    def poll(self):
+        last_prune = time.monotonic()
+        while True:
+            time.sleep(BUS_POLL_INTERVAL)
+            try:
+                with self.db_lock:
+                    events = self.db.execute(
+                        "SELECT id, origin, kind, email, frame FROM events WHERE id>? ORDER BY id",
+                        (self.last_id,)
+                    ).fetchall()
+                    if time.monotonic() - last_prune > BUS_RETENTION:
+                        self.db.execute("DELETE FROM events WHERE created_at<?", (time.time() - BUS_RETENTION,))
+                        last_prune = time.monotonic()
+                for event_id, origin, kind, email, frame in events:
+                    self.last_id = event_id
+                    if origin != self.origin:
+                        self.apply(kind, email, frame)
+            except Exception as e:
+                print(f"Error reading the session bus: {e}")
+
+    def apply(self, kind, email, frame):
+        if kind == "send":
+            self.deliver(email, frame)
+        elif kind == "logout":
+            LocalRegistry.logout(self, email)
+        elif kind == "discard":
+            LocalRegistry.discard(self, email)
+        elif kind == "invalidate":
+            database_helper.invalidate_session(email or None, frame, notify=False)
+
+    def may_reach(self, email):
+        #the socket may be held by another worker
+        return True
+
+    def register(self, email, ws):
+        super().register(email, ws)
+        #log out the sockets other workers hold for this user
+        self.publish("logout", email)
+
+    def send(self, email, frame):
+        if not self.deliver(email, frame):
+            self.publish("send", email, frame)
+
+    def logout(self, email):
+        super().logout(email)
+        self.publish("logout", email)
+
+    def discard(self, email):
+        super().discard(email)
+        self.publish("discard", email)
+
+
+def create_registry():
+    if REGISTRY_BACKEND == "sqlite":
+        return SqliteBusRegistry()
+    return LocalRegistry()
@@ -73,7 +73,9 @@ function getUserFriendlyMessage(error) {
     401: "Authentication failed. Please log in again.",
     404: "The requested resource was not found.",
     409: "There was a conflict with the current state.",
-    500: "Something went wrong on our end. Please try again later."
+    429: "You are doing that too often. Please wait a moment and try again.",
+    500: "Something went wrong on our end. Please try again later.",
+    503: "The server is busy right now. Please try again in a moment."
   };
 
   if (error.status === 401 && error.message === "Wrong password") {
@@ -128,6 +130,7 @@ function validatePasswordMatch(password, confirmPassword) {
 function displayDefaultView() {
     const token = localStorage.getItem("token");
     if (token) {
+      establishWebSocketConnection(token);
       displayView("profileview");
     } else {
       displayView("welcomeview");
@@ -217,32 +220,89 @@ function handleLoginForm() {
 
 
 // -----------------------Websocket----------------------------------
+// The server pushes every new post on our wall as {type: "post", ...}. After a reconnect we
+// ask for the posts we missed with {type: "since", post_id}, the last post id we have seen.
+let socket = null;
+
+function rememberPostId(postId) {
+    const lastPostId = parseInt(localStorage.getItem("lastPostId") || "0", 10);
+    if (postId > lastPostId) {
+      localStorage.setItem("lastPostId", postId);
+    }
+}
+
 function establishWebSocketConnection(token) {
     const ws = new WebSocket(`ws://127.0.0.1:8000/ws`);
+    socket = ws;
 
     ws.onopen = () => {
       console.log("WebSocket connected.");
       ws.send(token); // Send the token once the connection is open
       console.log("Token sent to server.");
+      const lastPostId = localStorage.getItem("lastPostId");
+      if (lastPostId) {
+        ws.send(JSON.stringify({ type: "since", post_id: parseInt(lastPostId, 10) }));
+      }
     };
 
     ws.onmessage = (event) => {
         if (event.data === "logout") {
-            console.log("Logged out from another session.");
-            showAlert("You have been logged out from another session.");
-            localStorage.removeItem("token");
-            displayView("welcomeview"); 
-            ws.close(); // Close the connection after logout
+            // Sent when the user logged in elsewhere or the token is no longer valid
+            console.log("Logged out by the server.");
+            showAlert("You have been logged out, please log in again.");
+            endSession(ws);
+            return;
+        }
+        const frame = JSON.parse(event.data);
+        if (frame.type === "post") {
+            addMessageToFeed(frame);
+        } else if (frame.type === "posts") {
+            frame.data.forEach(addMessageToFeed);
         }
     };
     ws.onerror = (error) => {
         console.error("WebSocket Error:", error);
         ws.close(); // Close connection on error
     };
+    ws.onclose = (event) => {
+        // A rejected token closes with 1008, even if the "logout" frame got lost: log out
+        if (event.code === 1008) {
+            if (socket === ws) {
+                endSession(ws);
+            }
+            return;
+        }
+        // Reconnect while we are still logged in, the "since" request fills the gap.
+        // A server at capacity closes with 1013, wait longer and spread the retries out
+        const token = localStorage.getItem("token");
+        if (socket === ws && token) {
+            const delay = event.code === 1013 ? 10000 + Math.random() * 20000 : 2000;
+            setTimeout(() => {
+              if (socket === ws && localStorage.getItem("token")) {
+                establishWebSocketConnection(localStorage.getItem("token"));
+              }
+            }, delay);
+        }
+    };
 
     return ws;
 }
 
+function endSession(ws) {
+    localStorage.removeItem("token");
+    socket = null;
+    displayView("welcomeview");
+    ws.close(); // Close the connection after logout
+}
+
+function closeWebSocketConnection() {
+    const ws = socket;
+    socket = null;
+    if (ws) {
+      ws.close();
+    }
+}
+
 
 // -----------------------Signup----------------------------------
 function handleSignupForm() {
@@ -300,8 +360,10 @@ function setupLogoutButton() {
         try {
           response = await apiRequest("http://127.0.0.1:8000/sign_out", "DELETE");
           console.log("Logout response:", response);
+          closeWebSocketConnection();
           localStorage.removeItem("token");
           localStorage.removeItem("email");
+          localStorage.removeItem("lastPostId");
           displayView("welcomeview");
           showAlert("Logout successful", true);
         } catch (error) {
@@ -353,15 +415,41 @@ function changePassword() {
   }
   
 // -----------------------User Data----------------------------------
+function showUserData(data) {
+    document.getElementById("userFirstName").innerText = data.firstname;
+    document.getElementById("userLastName").innerText = data.lastname;
+    document.getElementById("userGender").innerText = data.gender;
+    document.getElementById("userEmail").innerText = data.email;
+    document.getElementById("userCity").innerText = data.city;
+    document.getElementById("userCountry").innerText = data.country;
+}
+
+// Fills the "<prefix>PostsReceived", "<prefix>PostsSent" and "<prefix>TopPosters" fields
+function showUserStats(prefix, stats) {
+    document.getElementById(prefix + "PostsReceived").innerText = stats.received;
+    document.getElementById(prefix + "PostsSent").innerText = stats.sent;
+    document.getElementById(prefix + "TopPosters").innerText = stats.top_posters
+      .map((poster) => `${poster.firstname ? poster.firstname + " " + poster.lastname : poster.email} (${poster.posts})`)
+      .join(", ");
+}
+
+// Loads the profile, its stats and the first page of the wall with a single signed request
 async function getUserData() {
     try {
-      const response = await apiRequest("http://127.0.0.1:8000/get_user_data_by_token", "GET");
-      document.getElementById("userFirstName").innerText = response.data.firstname;
-      document.getElementById("userLastName").innerText = response.data.lastname;
-      document.getElementById("userGender").innerText = response.data.gender;
-      document.getElementById("userEmail").innerText = response.data.email;
-      document.getElementById("userCity").innerText = response.data.city;
-      document.getElementById("userCountry").innerText = response.data.country;
+      const response = await apiRequest("http://127.0.0.1:8000/batch", "POST", {
+        operations: [{ op: "get_user_data_by_token" }, { op: "get_user_messages_by_token" }, { op: "get_user_stats" }]
+      });
+      const [userData, messages, stats] = response.data;
+      if (userData.status !== 200) {
+        throw { status: userData.status, message: userData.body.message };
+      }
+      showUserData(userData.body.data);
+      if (messages.status === 200) {
+        showMessages(messages.body.data, messages.body.next_before_id);
+      }
+      if (stats.status === 200) {
+        showUserStats("user", stats.body.data);
+      }
       
     } catch (error) {
       console.error("User data error:", error);
@@ -397,6 +485,55 @@ function postMessage() {
 
   
 // -----------------------Get Messages----------------------------------
+// Posts on your own wall are shown as "Me: ...", others with the sender's name
+function formatPost(msg) {
+    if (msg.sent_by === msg.sent_to) {
+      return "Me: " + msg.post;
+    }
+    return msg.sender.firstname + " " + msg.sender.lastname + ": " + msg.post;
+}
+
+function createMessageElement(msg) {
+    const messageElement = document.createElement("div");
+    messageElement.classList.add("message");
+    messageElement.textContent = formatPost(msg);
+    messageElement.setAttribute("draggable", "true"); // Enable drag
+    messageElement.setAttribute("id", "msg" + msg.post_id); // Unique ID
+    messageElement.addEventListener("dragstart", handleDragStart);
+    return messageElement;
+}
+
+// Adds a pushed post on top of our own feed, the feed is newest first
+function addMessageToFeed(msg) {
+    rememberPostId(msg.post_id);
+    const messageFeed = document.getElementById("messageFeed");
+    if (!messageFeed || msg.sent_to !== localStorage.getItem("email")) return;
+    if (document.getElementById("msg" + msg.post_id)) return;
+    messageFeed.insertBefore(createMessageElement(msg), messageFeed.firstChild);
+}
+
+// Walls come in pages of the newest posts, the "Load older posts" button asks for the page
+// before the oldest post shown and is hidden once the server has no next_before_id left
+function setOlderButton(buttonId, nextBeforeId) {
+    const button = document.getElementById(buttonId);
+    button.hidden = nextBeforeId === null || nextBeforeId === undefined;
+    button.dataset.beforeId = button.hidden ? "" : nextBeforeId;
+}
+
+function showMessages(messages, nextBeforeId, append = false) {
+    const messageFeed = document.getElementById("messageFeed");
+    if (!append) {
+        messageFeed.innerHTML = "";
+    }
+    messages.forEach(msg => {
+        rememberPostId(msg.post_id);
+        if (!document.getElementById("msg" + msg.post_id)) {
+            messageFeed.appendChild(createMessageElement(msg));
+        }
+    });
+    setOlderButton("olderMessageButton", nextBeforeId);
+}
+
 function getMessages() {
     const reloadMessageButton = document.getElementById("reloadMessageButton");
     if (!reloadMessageButton.dataset.listenerAdded) {
@@ -404,18 +541,7 @@ function getMessages() {
         reloadMessageButton.addEventListener("click", async function () {
             try {
                 const response = await apiRequest("http://127.0.0.1:8000/get_user_messages_by_token", "GET");
-                const messageFeed = document.getElementById("messageFeed");
-                messageFeed.innerHTML = "";
-
-                response.data.forEach((msg, index) => {
-                    const messageElement = document.createElement("div");
-                    messageElement.classList.add("message");
-                    messageElement.textContent = msg.post;
-                    messageElement.setAttribute("draggable", "true"); // Enable drag
-                    messageElement.setAttribute("id", "msg" + index); // Unique ID
-                    messageElement.addEventListener("dragstart", handleDragStart);
-                    messageFeed.appendChild(messageElement);
-                });
+                showMessages(response.data, response.next_before_id);
 
             } catch (error) {
                 console.error("Get messages error:", error);
@@ -423,6 +549,19 @@ function getMessages() {
             }
         });
     }
+    const olderMessageButton = document.getElementById("olderMessageButton");
+    if (!olderMessageButton.dataset.listenerAdded) {
+        olderMessageButton.dataset.listenerAdded = "true";
+        olderMessageButton.addEventListener("click", async function () {
+            try {
+                const response = await apiRequest("http://127.0.0.1:8000/get_user_messages_by_token?before_id=" + olderMessageButton.dataset.beforeId, "GET");
+                showMessages(response.data, response.next_before_id, true);
+            } catch (error) {
+                console.error("Get older messages error:", error);
+                showAlert(getUserFriendlyMessage(error));
+            }
+        });
+    }
 }
 
 // -----------------------Drag and Drop----------------------------------
@@ -451,6 +590,16 @@ function enableDragAndDrop() {
 }
 
 // -----------------------Find User By Email----------------------------------
+function showBrowseUserData(data) {
+    document.getElementById("browseFirstName").innerText = data.firstname;
+    document.getElementById("browseLastName").innerText = data.lastname;
+    document.getElementById("browseGender").innerText = data.gender;
+    document.getElementById("browseEmailDisplay").innerText = data.email;
+    document.getElementById("browseCity").innerText = data.city;
+    document.getElementById("browseCountry").innerText = data.country;
+}
+
+// Loads the other user's profile, stats and wall with a single signed request
 function findUserByEmail() {
     const findUserButton = document.getElementById("browseButton");
     findUserButton.addEventListener("click", async function () {
@@ -461,13 +610,24 @@ function findUserByEmail() {
         return;
       }
       try {
-        const response = await apiRequest("http://127.0.0.1:8000/get_user_data_by_email/" + encodeURIComponent(email), "GET");
-          document.getElementById("browseFirstName").innerText = response.data.firstname;
-          document.getElementById("browseLastName").innerText = response.data.lastname;
-          document.getElementById("browseGender").innerText = response.data.gender;
-          document.getElementById("browseEmailDisplay").innerText = response.data.email;
-          document.getElementById("browseCity").innerText = response.data.city;
-          document.getElementById("browseCountry").innerText = response.data.country;
+        const response = await apiRequest("http://127.0.0.1:8000/batch", "POST", {
+          operations: [
+            { op: "get_user_data_by_email", email: email },
+            { op: "get_user_messages_by_email", email: email },
+            { op: "get_user_stats", email: email }
+          ]
+        });
+        const [userData, messages, stats] = response.data;
+        if (userData.status !== 200) {
+          throw { status: userData.status === 404 ? 401 : userData.status, message: userData.body.message };
+        }
+        showBrowseUserData(userData.body.data);
+        if (messages.status === 200) {
+          showBrowseMessages(email, messages.body.data, messages.body.next_before_id);
+        }
+        if (stats.status === 200) {
+          showUserStats("browse", stats.body.data);
+        }
       } catch (error) {
         console.error("Find user error:", error);
       
@@ -508,6 +668,22 @@ function postMessageByBrowser() {
 
   
 // -----------------------Get Messages By Browser----------------------------------
+// email is the wall shown, older pages are fetched for it even if the search field changed
+function showBrowseMessages(email, messages, nextBeforeId, append = false) {
+    const messageFeed = document.getElementById("messageFeedBrowser");
+    if (!append) {
+      messageFeed.innerHTML = "";
+      messageFeed.dataset.email = email;
+    }
+    messages.forEach(msg => {
+      const messageElement = document.createElement("div");
+      messageElement.classList.add("message");
+      messageElement.textContent = formatPost(msg);
+      messageFeed.appendChild(messageElement);
+    });
+    setOlderButton("olderMessageButtonBrowser", nextBeforeId);
+}
+
 function getMessagesByBrowser() {
     const reloadMessageButtonBrowser = document.getElementById("reloadMessageButtonBrowser");
     reloadMessageButtonBrowser.addEventListener("click", async function () {
@@ -518,19 +694,24 @@ function getMessagesByBrowser() {
       }
       try {
         const response = await apiRequest("http://127.0.0.1:8000/get_user_messages_by_email/" + encodeURIComponent(email), "GET");
-          const messageFeed = document.getElementById("messageFeedBrowser");
-          messageFeed.innerHTML = "";
-          response.data.forEach(msg => {
-            const messageElement = document.createElement("div");
-            messageElement.classList.add("message");
-            messageElement.textContent = msg.post;
-            messageFeed.appendChild(messageElement);
-          });
+          showBrowseMessages(email, response.data, response.next_before_id);
       } catch (error) {
         console.error("Get messages by browser error:", error);
             showAlert(getUserFriendlyMessage(error));
       }
     });
+    const olderMessageButtonBrowser = document.getElementById("olderMessageButtonBrowser");
+    olderMessageButtonBrowser.addEventListener("click", async function () {
+      const email = document.getElementById("messageFeedBrowser").dataset.email;
+      try {
+        const response = await apiRequest("http://127.0.0.1:8000/get_user_messages_by_email/" + encodeURIComponent(email)
+          + "?before_id=" + olderMessageButtonBrowser.dataset.beforeId, "GET");
+        showBrowseMessages(email, response.data, response.next_before_id, true);
+      } catch (error) {
+        console.error("Get older messages by browser error:", error);
+        showAlert(getUserFriendlyMessage(error));
+      }
+    });
   }
   
 // -----------------------Event Listener----------------------------------